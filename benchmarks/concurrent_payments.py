@@ -0,0 +1,140 @@
+# Benchmark de concorrência: muitos pagamentos em paralelo sobre a mesma fatura
+#
+# Compara o fluxo antigo (ler 'total_price' e escrever o novo valor noutra instrução) com o
+# fluxo de instrução única 'PAY_BILL_SQL' do 'hms-api.py'. No fim verifica se o valor pago
+# da fatura coincide com a soma do 'ledger' e se nenhum pagamento excedeu o valor em falta.
+#
+# Usar SEMPRE uma base de dados de testes: o script cria dados de exemplo.
+# A ligação é a mesma da API ('HMS_PRIMARY_DSN').
+# Uso: python benchmarks/concurrent_payments.py [payers] [pagamentos por payer]
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hms-api.py')
+
+
+BENCH_PATIENT = 'benchpayer'
+BENCH_DOCTOR = 'benchdoctor'
+
+
+def load_api():
+    spec = importlib.util.spec_from_file_location('hms_api', API_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def setup_bill(cur, total_price):
+    # Paciente, médico e consulta de teste (o trigger da consulta cria a fatura)
+    for username in (BENCH_PATIENT, BENCH_DOCTOR):
+        cur.execute('''INSERT INTO person (username, password, name, mobile_number, birth_date, address, email)
+                       VALUES (%s, 'x', 'Bench', %s, '2000-01-01', 'Bench', %s) ON CONFLICT DO NOTHING''',
+                    (username, abs(hash(username)) % 10 ** 9, f'{username}@bench.local'))
+    cur.execute('INSERT INTO patient (person_username) VALUES (%s) ON CONFLICT DO NOTHING', (BENCH_PATIENT,))
+    cur.execute('''INSERT INTO employee_contract (contract_salary, contract_start_date, person_username)
+                   VALUES (1, '2024-01-01', %s) ON CONFLICT DO NOTHING''', (BENCH_DOCTOR,))
+    cur.execute('''INSERT INTO doctors (doctor_license, employee_contract_person_username)
+                   VALUES ('bench', %s) ON CONFLICT DO NOTHING''', (BENCH_DOCTOR,))
+    # Cada execução usa um intervalo livre a seguir às consultas de teste já marcadas
+    # (as restrições de exclusão de schedule_slots impedem consultas sobrepostas)
+    cur.execute('''INSERT INTO appointments (appointment_date, patient_person_username,
+                   doctors_employee_contract_person_username)
+                   SELECT COALESCE(MAX(appointment_date + duration), date_trunc('minute', NOW())), %s, %s
+                   FROM appointments
+                   WHERE doctors_employee_contract_person_username = %s OR patient_person_username = %s
+                   RETURNING appointment_id''',
+                (BENCH_PATIENT, BENCH_DOCTOR, BENCH_DOCTOR, BENCH_PATIENT))
+    appointment_id = cur.fetchone()[0]
+
+    # Fatura criada pelo trigger da consulta
+    cur.execute('SELECT bill_id FROM bills WHERE appointments_appointment_id = %s', (appointment_id,))
+    bill_id = cur.fetchone()[0]
+    cur.execute('UPDATE bills SET total_price = %s, amount_paid = 0, payment_method = NULL WHERE bill_id = %s',
+                (total_price, bill_id))
+    cur.execute('DELETE FROM payments WHERE bills_bill_id = %s', (bill_id,))
+    return bill_id
+
+
+def legacy_payment(cur, bill_id, amount):
+    # Fluxo antigo: leitura e escrita em instruções separadas, sem bloqueio
+    cur.execute('SELECT total_price - amount_paid FROM bills WHERE bill_id = %s', (bill_id,))
+    remaining = cur.fetchone()[0] - amount
+    if remaining < 0:
+        return None
+    cur.execute('INSERT INTO payments (payment_amount, deadline_date, bills_bill_id) VALUES (%s, NOW(), %s)',
+                (amount, bill_id))
+    cur.execute('UPDATE bills SET amount_paid = total_price - %s WHERE bill_id = %s', (remaining, bill_id))
+    return remaining,
+
+
+def run(dsn, label, pay, payers, per_payer, amount, total_price):
+    db = psycopg2.connect(dsn)
+    cur = db.cursor()
+    bill_id = setup_bill(cur, total_price)
+    db.commit()
+
+    accepted = [0] * payers
+
+    def payer(index):
+        conn = psycopg2.connect(dsn)
+        c = conn.cursor()
+        for _ in range(per_payer):
+            result = pay(c, bill_id, amount)
+            conn.commit()
+            if result is not None:
+                accepted[index] += 1
+        c.close()
+        conn.close()
+
+    threads = [threading.Thread(target=payer, args=(i,)) for i in range(payers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    cur.execute('''SELECT b.total_price, b.amount_paid, COALESCE(SUM(p.payment_amount), 0), COUNT(p.payment_id)
+                   FROM bills b LEFT JOIN payments p ON p.bills_bill_id = b.bill_id
+                   WHERE b.bill_id = %s GROUP BY b.bill_id''', (bill_id,))
+    price, amount_paid, ledger_sum, ledger_rows = cur.fetchone()
+    cur.close()
+    db.close()
+
+    attempts = payers * per_payer
+    ok = amount_paid == ledger_sum == sum(accepted) * amount and amount_paid <= price
+    print(f'{label:<14} {attempts / elapsed:9.0f} pagamentos/s  aceites={sum(accepted):<6} '
+          f'pago={amount_paid:<8} ledger={ledger_sum:<8} preço={price:<8} {"OK" if ok else "INCONSISTENTE"}')
+
+
+def main():
+    payers = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    per_payer = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    amount = 1
+    # Preço inferior ao total tentado, para exercitar também a recusa de pagamentos em excesso
+    total_price = payers * per_payer * amount * 3 // 4
+
+    api = load_api()
+
+    def single_statement(cur, bill_id, value):
+        return api.pay_bill(cur, bill_id, BENCH_PATIENT, value, 'card')
+
+    def legacy(cur, bill_id, value):
+        try:
+            return legacy_payment(cur, bill_id, value)
+        except psycopg2.Error:
+            cur.connection.rollback()
+            return None
+
+    print(f'{payers} payers x {per_payer} pagamentos de {amount} (preço da fatura: {total_price})')
+    run(api.DB_PRIMARY_DSN, 'leitura+escrita', legacy, payers, per_payer, amount, total_price)
+    run(api.DB_PRIMARY_DSN, 'PAY_BILL_SQL', single_statement, payers, per_payer, amount, total_price)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Microbenchmark: custo de serialização das listagens por cada 10k linhas
+#
+# Compara o caminho antigo (dicts linha a linha + 'jsonify' com o provider por omissão),
+# o mesmo caminho com o provider 'orjson' e o caminho pass-through (documento JSON
+# construído pelo Postgres e enviado como bytes).
+#
+# Uso: python benchmarks/json_serialization.py [linhas] [repetições]
+import importlib.util
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hms-api.py')
+
+
+def load_api():
+    spec = importlib.util.spec_from_file_location('hms_api', API_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_rows(n):
+    # Linhas no formato devolvido pelo 'cur.fetchall()' em 'see_appointments'
+    start = datetime(2024, 1, 1, 9, 0, 0)
+    return [(i, 'doctor%d' % (i % 50), start + timedelta(minutes=30 * i)) for i in range(n)]
+
+
+def make_document(rows):
+    # Equivalente ao texto devolvido pelo Postgres com 'json_build_object(...)::text'
+    results = [{"id": r[0], "doctor_id": r[1], "date": r[2].isoformat()} for r in rows]
+    return json.dumps({"status": 200, "results": results}, separators=(',', ':'))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    api = load_api()
+    rows = make_rows(n)
+    document = make_document(rows)
+
+    default_app = Flask('default')
+    default_app.json = DefaultJSONProvider(default_app)
+
+    def build_and_jsonify(app):
+        with app.app_context():
+            results = [{"id": appt[0], "doctor_id": appt[1], "date": appt[2]} for appt in rows]
+            app.json.response({"status": 200, "results": results}).get_data()
+
+    def passthrough():
+        with api.app.app_context():
+            api.app.response_class(document.encode(), status=200, mimetype='application/json').get_data()
+
+    def decode_encode():
+        # Caso do 'json_agg' sem '::text': o psycopg2 descodifica e o Flask volta a codificar
+        with api.app.app_context():
+            api.app.json.response(json.loads(document)).get_data()
+
+    cases = [('dicts + DefaultJSONProvider', lambda: build_and_jsonify(default_app))]
+    if api.orjson is not None:
+        cases.append(('dicts + OrjsonProvider', lambda: build_and_jsonify(api.app)))
+    else:
+        print('orjson não instalado: o caso OrjsonProvider é ignorado')
+    cases.append(('json_agg decode + encode', decode_encode))
+    cases.append(('pass-through (::text -> bytes)', passthrough))
+
+    print(f'{n} linhas, melhor de {repeat} execuções')
+    for label, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        print(f'{label:<34} {best * 1000:8.2f} ms  ({best * 1000 * 10000 / n:8.2f} ms / 10k linhas)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Benchmark: instruções preparadas (PREPARE/EXECUTE) vs. 'parse' e planeamento em cada pedido
+#
+# Mede os caminhos de login (procura da password) e de marcação de consulta (verificação de
+# perfis), com as instruções do registo 'PREPARED_STATEMENTS' do 'hms-api.py'.
+# Mostra também o tempo de planeamento de cada instrução reportado pelo Postgres.
+#
+# Uso: python benchmarks/prepared_statements.py [iterações]
+import importlib.util
+import os
+import re
+import sys
+import time
+
+import psycopg2
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hms-api.py')
+
+PATHS = {
+    'login': [('login_password', ('benchuser',))],
+    'booking': [
+        ('is_patient', ('benchuser',)),
+        ('is_doctor', ('benchdoctor',)),
+    ],
+}
+
+
+def load_api():
+    spec = importlib.util.spec_from_file_location('hms_api', API_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def plain_query(api, name):
+    # A mesma instrução com parâmetros do psycopg2, enviada e planeada em cada execução
+    query = api.PREPARED_STATEMENTS[name][1]
+    return re.sub(r'\$\d+', '%s', query)
+
+
+def planning_time(cur, sql, params):
+    cur.execute('EXPLAIN (ANALYZE, SUMMARY) ' + sql, params)
+    for (line,) in cur.fetchall():
+        found = re.match(r'\s*Planning Time: ([\d.]+) ms', line)
+        if found:
+            return float(found.group(1))
+    return None
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    api = load_api()
+
+    db = psycopg2.connect(api.DB_PRIMARY_DSN, connection_factory=api.PooledConnection)
+    cur = db.cursor()
+
+    print(f'{iterations} execuções por caminho')
+    for path, statements in PATHS.items():
+        plain = [(plain_query(api, name), params) for name, params in statements]
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for sql, params in plain:
+                cur.execute(sql, params)
+                cur.fetchone()
+        plain_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for name, params in statements:
+                api.execute_prepared(cur, name, params)
+                cur.fetchone()
+        prepared_elapsed = time.perf_counter() - start
+
+        print(f'{path:<8} sem PREPARE: {plain_elapsed / iterations * 1e6:8.1f} us/pedido   '
+              f'com PREPARE: {prepared_elapsed / iterations * 1e6:8.1f} us/pedido   '
+              f'({(1 - prepared_elapsed / plain_elapsed) * 100:5.1f}% menos)')
+
+        for (sql, params), (name, _) in zip(plain, statements):
+            plan_ms = planning_time(cur, sql, params)
+            if plan_ms is not None:
+                print(f'         planeamento de {name}: {plan_ms:.3f} ms por execução sem PREPARE')
+
+    db.rollback()
+    cur.close()
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,29 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, has_app_context, jsonify, request, url_for
+from flask.json.provider import DefaultJSONProvider
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from werkzeug.test import EnvironBuilder
+from werkzeug.routing import BuildError
+from datetime import date as dt_date, datetime, timedelta
+from functools import wraps
 from re import match
 import psycopg2
+import threading
+import atexit
 import logging
+import queue
+import select
+import time
+import json
+import zlib
+import base64
+import io
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
@@ -12,6 +31,39 @@ app = Flask(__name__)
 app.config['JWT_SECRET_KEY'] = 'aY21z'
 jwt = JWTManager(app)
 
+
+##########################################################
+# JSON PROVIDER
+##########################################################
+class IsoJSONProvider(DefaultJSONProvider):
+    # Datas em ISO 8601 (ex.: "2024-01-01T10:00:00"), tal como o 'orjson' e os documentos JSON
+    # construídos pelo Postgres, em vez do formato RFC 1123 do Flask ("Mon, 01 Jan 2024 ...")
+    @staticmethod
+    def default(o):
+        if isinstance(o, (datetime, dt_date)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+
+class OrjsonProvider(IsoJSONProvider):
+    # Serialização com 'orjson' (datas em ISO 8601, tipos não suportados passam pelo 'default')
+    option = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+# Usar o 'orjson' se estiver instalado; o formato das datas é o mesmo nos dois casos
+app.json = OrjsonProvider(app) if orjson is not None else IsoJSONProvider(app)
+
 # Lista de códigos de 'status'
 StatusCodes = {
     'success': 200,
@@ -23,20 +75,580 @@ StatusCodes = {
 ##########################################################
 # DATABASE ACCESS
 ##########################################################
+# Base de dados principal (escritas) e réplicas de leitura, separadas por ';'
+DB_PRIMARY_DSN = os.environ.get('HMS_PRIMARY_DSN',
+                                'host=127.0.0.1 port=5432 dbname=HMS user=postgres password=postgres')
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('HMS_REPLICA_DSNS', '').split(';') if dsn.strip()]
+
+# Atraso máximo de replicação aceite (bytes de WAL) e intervalo entre verificações das réplicas
+REPLICA_MAX_LAG_BYTES = 16 * 1024 * 1024
+REPLICA_CHECK_INTERVAL = 5
+# Depois de uma escrita, as leituras do mesmo utilizador vão para a principal durante este tempo
+READ_YOUR_WRITES_SECONDS = 10
+
+
+# Ligações inativas mantidas por cada base de dados (principal e réplicas)
+POOL_MAX_IDLE = 10
+# Ligações inativas há mais tempo do que isto são verificadas (SELECT 1) antes de serem reutilizadas
+POOL_VERIFY_AFTER_IDLE = 30
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # 'close()' devolve a ligação ao 'pool'; as instruções preparadas ficam associadas à ligação
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.prepared = set()
+        self.idle_since = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super().close()
+
+    def discard(self):
+        # Fecha mesmo a ligação (ex.: estado desconhecido após um COPY interrompido)
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    def __init__(self, dsn, max_idle=POOL_MAX_IDLE):
+        self.dsn = dsn
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def is_alive(self, conn):
+        # 'conn.closed' só muda depois de um erro visto pelo cliente: uma sessão terminada no servidor
+        # (reinício, 'failover') deixa o 'socket' legível (fim da ligação) ou só é detetada ao usar a
+        # ligação. Só se faz um pedido ao servidor nesses casos ou após uma inatividade longa.
+        if conn.closed:
+            return False
+        suspect = (time.monotonic() - conn.idle_since > POOL_VERIFY_AFTER_IDLE
+                   or select.select([conn], [], [], 0)[0])
+        if not suspect:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, **kwargs):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if self.is_alive(conn):
+                conn.pool = self
+                return conn
+            conn.discard()
+        # Nova ligação: começa sem instruções preparadas (são preparadas de novo quando usadas)
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, **kwargs)
+        conn.pool = self
+        return conn
+
+    def putconn(self, conn):
+        conn.pool = None
+        if conn.closed:
+            return
+        try:
+            # Terminar qualquer transação deixada aberta pelo pedido
+            conn.rollback()
+        except Exception:
+            conn.discard()
+            return
+        conn.idle_since = time.monotonic()
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.discard()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(dsn):
+    with pools_lock:
+        if dsn not in pools:
+            pools[dsn] = ConnectionPool(dsn)
+        return pools[dsn]
+
+
 def db_connection():
+    # Dentro de um pedido '/dbproj/batch' todas as operações usam a mesma ligação
+    if has_app_context() and g.get('batch_connection') is not None:
+        return g.batch_connection
     try:
-        db = psycopg2.connect(
-            user='postgres',
-            password='postgres',
-            host='127.0.0.1',
-            port='5432',
-            database='HMS'
-        )
+        db = get_pool(DB_PRIMARY_DSN).getconn()
         return db
     except Exception as e:
         return {"msg": str(e)}, 500
 
 
+replica_state = {dsn: {"healthy": False, "lag_bytes": None} for dsn in DB_REPLICA_DSNS}
+replica_lock = threading.Lock()
+replica_next = 0
+replica_monitor_started = False
+recent_writers = {}
+
+
+def check_replicas():
+    # Posição atual do WAL na principal, comparada com o WAL já aplicado em cada réplica
+    try:
+        db = psycopg2.connect(DB_PRIMARY_DSN, connect_timeout=2)
+        try:
+            cur = db.cursor()
+            cur.execute('SELECT pg_current_wal_lsn()')
+            primary_lsn = cur.fetchone()[0]
+        finally:
+            db.close()
+    except Exception:
+        primary_lsn = None
+
+    for dsn in DB_REPLICA_DSNS:
+        healthy, lag_bytes = False, None
+        try:
+            db = psycopg2.connect(dsn, connect_timeout=2)
+            try:
+                cur = db.cursor()
+                cur.execute('SELECT pg_is_in_recovery(), pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn())',
+                            (primary_lsn,))
+                in_recovery, lag_bytes = cur.fetchone()
+                # Uma instância que não está em recuperação não recebe o WAL da principal (ex.: uma
+                # cópia independente ou uma réplica promovida): as leituras não refletiriam as escritas
+                if not in_recovery:
+                    logging.getLogger('logger').warning(f'Replica is not in recovery: {dsn}')
+                    lag_bytes = None
+                healthy = lag_bytes is not None and lag_bytes <= REPLICA_MAX_LAG_BYTES
+            finally:
+                db.close()
+        except Exception as e:
+            logging.getLogger('logger').warning(f'Replica health check failed: {e}')
+        with replica_lock:
+            replica_state[dsn] = {"healthy": healthy, "lag_bytes": lag_bytes}
+
+    # Utilizadores cujo período de read-your-writes já terminou
+    now = time.monotonic()
+    with replica_lock:
+        for username in [u for u, until in recent_writers.items() if until < now]:
+            del recent_writers[username]
+
+
+def monitor_replicas():
+    try:
+        check_replicas()
+    finally:
+        timer = threading.Timer(REPLICA_CHECK_INTERVAL, monitor_replicas)
+        timer.daemon = True
+        timer.start()
+
+
+def start_replica_monitor():
+    global replica_monitor_started
+    with replica_lock:
+        if replica_monitor_started or not DB_REPLICA_DSNS:
+            return
+        replica_monitor_started = True
+    # A primeira verificação corre em segundo plano: até lá as leituras vão para a principal
+    threading.Thread(target=monitor_replicas, daemon=True).start()
+
+
+def mark_recent_write(username):
+    with replica_lock:
+        recent_writers[username.lower()] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+
+
+def wrote_recently(username):
+    with replica_lock:
+        until = recent_writers.get(username.lower())
+        if until is not None and until < time.monotonic():
+            del recent_writers[username.lower()]
+            until = None
+    return until is not None
+
+
+def next_healthy_replica():
+    # Seleção 'round-robin' entre as réplicas saudáveis
+    global replica_next
+    with replica_lock:
+        healthy = [dsn for dsn in DB_REPLICA_DSNS if replica_state[dsn]["healthy"]]
+        if not healthy:
+            return None
+        dsn = healthy[replica_next % len(healthy)]
+        replica_next += 1
+    return dsn
+
+
+def db_read_connection():
+    # Ligação para rotas só de leitura: réplica saudável, exceto logo após uma escrita do mesmo utilizador
+    if has_app_context() and g.get('batch_connection') is not None:
+        return g.batch_connection
+    start_replica_monitor()
+    try:
+        username = get_jwt_identity()
+    except RuntimeError:
+        username = None
+    if username is None or not wrote_recently(username):
+        dsn = next_healthy_replica()
+        if dsn is not None:
+            try:
+                return get_pool(dsn).getconn(connect_timeout=2)
+            except Exception:
+                with replica_lock:
+                    replica_state[dsn]["healthy"] = False
+    return db_connection()
+
+
+@app.after_request
+def track_writes(response):
+    # Registar os utilizadores que acabaram de escrever (read-your-writes)
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        try:
+            username = get_jwt_identity()
+        except RuntimeError:
+            username = None
+        if username:
+            mark_recent_write(username)
+    return response
+
+
+##########################################################
+# NOTIFICATIONS (LISTEN/NOTIFY)
+##########################################################
+# Uma única ligação dedicada (LISTEN) por processo para todos os canais registados com
+# listen_channel(): canal -> (função chamada com o 'payload', função chamada após cada LISTEN)
+NOTIFY_CHANNELS = {}
+NOTIFY_POLL_SECONDS = 15
+NOTIFY_RECONNECT_SECONDS = 5
+
+notify_lock = threading.Lock()
+notify_listener_started = False
+
+
+def listen_channel(channel, on_notify, on_reconnect=None):
+    NOTIFY_CHANNELS[channel] = (on_notify, on_reconnect)
+
+
+def notification_listener():
+    while True:
+        try:
+            db = psycopg2.connect(DB_PRIMARY_DSN)
+            try:
+                db.autocommit = True
+                cur = db.cursor()
+                for channel in NOTIFY_CHANNELS:
+                    cur.execute(f'LISTEN {channel}')
+                # Antes do LISTEN (no arranque ou após uma falha da ligação) podem ter-se perdido
+                # notificações: as caches carregadas entretanto são invalidadas
+                for _, on_reconnect in NOTIFY_CHANNELS.values():
+                    if on_reconnect is not None:
+                        on_reconnect()
+                while True:
+                    if select.select([db], [], [], NOTIFY_POLL_SECONDS) == ([], [], []):
+                        # Sem notificações: confirmar que a ligação continua ativa
+                        cur.execute('SELECT 1')
+                        continue
+                    db.poll()
+                    while db.notifies:
+                        notify = db.notifies.pop(0)
+                        NOTIFY_CHANNELS[notify.channel][0](notify.payload)
+            finally:
+                db.close()
+        except Exception as e:
+            logging.getLogger('logger').warning(f'Notification listener error: {e}')
+        time.sleep(NOTIFY_RECONNECT_SECONDS)
+
+
+def start_notification_listener():
+    global notify_listener_started
+    with notify_lock:
+        if notify_listener_started:
+            return
+        notify_listener_started = True
+    threading.Thread(target=notification_listener, daemon=True).start()
+
+
+##########################################################
+# PREPARED STATEMENTS
+##########################################################
+# Instruções usadas em quase todos os pedidos: preparadas uma vez por ligação (PREPARE) e
+# executadas com EXECUTE, evitando o 'parse' e o planeamento em cada pedido
+PREPARED_STATEMENTS = {
+    'is_patient': ('text', 'SELECT 1 FROM patient WHERE LOWER(person_username) = LOWER($1)'),
+    'is_doctor': ('text', 'SELECT 1 FROM doctors WHERE LOWER(employee_contract_person_username) = LOWER($1)'),
+    'is_nurse': ('text', 'SELECT 1 FROM nurses WHERE LOWER(employee_contract_person_username) = LOWER($1)'),
+    'is_assistant': ('text', 'SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER($1)'),
+    'is_employee': ('text', 'SELECT 1 FROM employee_contract WHERE LOWER(person_username) = LOWER($1)'),
+    'login_password': ('text', 'SELECT password FROM person WHERE username = $1'),
+}
+
+
+def prepare_statement(cur, name):
+    types, query = PREPARED_STATEMENTS[name]
+    cur.execute(f'PREPARE {name} ({types}) AS {query}')
+    cur.connection.prepared.add(name)
+
+
+def execute_prepared(cur, name, params):
+    conn = cur.connection
+    if name not in conn.prepared:
+        prepare_statement(cur, name)
+    placeholders = ', '.join(['%s'] * len(params))
+    # Num 'batch' transacional, um erro só pode anular esta instrução (e não as operações
+    # anteriores): o 'savepoint' segue no mesmo pedido ao servidor que o EXECUTE
+    batch = g.get('batch_connection') if has_app_context() else None
+    in_batch = batch is not None and batch.atomic
+    savepoint = 'SAVEPOINT execute_prepared; ' if in_batch else ''
+    try:
+        cur.execute(f'{savepoint}EXECUTE {name} ({placeholders})', params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # A instrução deixou de existir no servidor (ex.: sessão reiniciada): preparar de novo
+        if in_batch:
+            cur.execute('ROLLBACK TO SAVEPOINT execute_prepared')
+        else:
+            conn.rollback()
+        conn.prepared.clear()
+        prepare_statement(cur, name)
+        cur.execute(f'EXECUTE {name} ({placeholders})', params)
+
+
+##########################################################
+# PASS-THROUGH JSON RESPONSE
+##########################################################
+def json_passthrough(cur, query, params=()):
+    # A query devolve o documento JSON final já construído pelo Postgres ('::text' evita o decode do psycopg2)
+    cur.execute(query, params)
+    document = cur.fetchone()[0]
+    return app.response_class(document.encode(), status=200, mimetype='application/json')
+
+
+##########################################################
+# CONDITIONAL GET (ETAG / 304)
+##########################################################
+def get_patient_version(cur, patient_id):
+    # Uma única leitura indexada: 'username' do paciente e versão atual dos seus dados clínicos
+    cur.execute('''
+        SELECT p.person_username, COALESCE(v.version, 0)
+        FROM patient p
+        LEFT JOIN patient_versions v ON v.patient_person_username = p.person_username
+        WHERE p.patient_id = %s
+    ''', (patient_id,))
+    return cur.fetchone()
+
+
+def patient_etag(resource, patient_id, version):
+    return f'{resource}-{patient_id}-{version}'
+
+
+def with_etag(response, etag):
+    # Os clientes devem revalidar sempre com 'If-None-Match'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(etag):
+    # Comparação fraca (RFC 9110, 13.1.2): 'W/"x"' corresponde a '"x"'
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
+    return None
+
+
+##########################################################
+# AUDIT TRAIL
+##########################################################
+# Acessos aos dados dos pacientes: os pedidos só acrescentam o evento a um 'buffer' limitado em
+# memória; um 'thread' escreve-os em lotes (COPY) quando há AUDIT_BATCH_SIZE eventos ou a cada
+# AUDIT_FLUSH_INTERVAL segundos. Com o 'buffer' cheio, o pedido espera até AUDIT_BLOCK_SECONDS
+# e, se continuar cheio, o evento é descartado e contado em 'dropped'.
+AUDIT_BUFFER_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 2
+AUDIT_BLOCK_SECONDS = 0.05
+# Ações que descrevem escritas: não são registadas se o 'batch' transacional for revertido
+AUDIT_WRITE_ACTIONS = {'pay'}
+AUDIT_COPY_SQL = '''
+    COPY access_audit (accessed_at, accessor_username, patient_person_username, resource, action, resource_id)
+    FROM STDIN
+'''
+AUDIT_INSERT_SQL = '''
+    INSERT INTO access_audit (accessed_at, accessor_username, patient_person_username, resource, action, resource_id)
+    VALUES (%s, %s, %s, %s, %s, %s)
+'''
+
+audit_buffer = queue.Queue(maxsize=AUDIT_BUFFER_SIZE)
+audit_wakeup = threading.Event()
+audit_flush_lock = threading.Lock()
+audit_lock = threading.Lock()
+audit_counters = {"written": 0, "dropped": 0, "rejected": 0, "failed_flushes": 0}
+# Lote cuja escrita falhou: é tentado de novo antes de novos eventos
+audit_retry = []
+audit_flusher_started = False
+
+
+def record_access(accessor, patient, resource, action, resource_id=None):
+    event = (datetime.now(), accessor, patient, resource, action, resource_id)
+    # Num 'batch' transacional, os eventos só são enviados para o 'buffer' no fim do 'batch'
+    batch_conn = g.get('batch_connection') if has_app_context() else None
+    if batch_conn is not None and batch_conn.atomic:
+        batch_conn.audit_events.append(event)
+        return
+    queue_audit_event(event)
+
+
+def queue_audit_event(event):
+    start_audit_flusher()
+    try:
+        audit_buffer.put(event, timeout=AUDIT_BLOCK_SECONDS)
+    except queue.Full:
+        with audit_lock:
+            audit_counters["dropped"] += 1
+        logging.getLogger('logger').warning(f'Audit buffer full, dropped access event: {event}')
+        return
+    if audit_buffer.qsize() >= AUDIT_BATCH_SIZE:
+        audit_wakeup.set()
+
+
+def copy_text_value(value):
+    # Formato de texto do COPY: NULL como \N e escape de barras, tabulações e mudanças de linha
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def write_audit_batch(events):
+    data = io.StringIO()
+    for event in events:
+        data.write('\t'.join(copy_text_value(value) for value in event) + '\n')
+    data.seek(0)
+
+    db = get_pool(DB_PRIMARY_DSN).getconn()
+    cur = db.cursor()
+    try:
+        cur.copy_expert(AUDIT_COPY_SQL, data)
+        db.commit()
+    finally:
+        cur.close()
+        db.close()
+
+
+def write_audit_rows(events):
+    # Alternativa ao COPY quando o lote tem eventos inválidos: escreve-os um a um e ignora os
+    # rejeitados, devolvendo quantos foram escritos
+    db = get_pool(DB_PRIMARY_DSN).getconn()
+    cur = db.cursor()
+    written = 0
+    try:
+        for event in events:
+            cur.execute('SAVEPOINT audit_event')
+            try:
+                cur.execute(AUDIT_INSERT_SQL, event)
+                written += 1
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                cur.execute('ROLLBACK TO SAVEPOINT audit_event')
+                logging.getLogger('logger').warning(f'Audit event rejected: {event}: {e}')
+        db.commit()
+        return written
+    finally:
+        cur.close()
+        db.close()
+
+
+def flush_audit_events():
+    # Escreve todos os eventos em espera, em lotes de AUDIT_BATCH_SIZE
+    global audit_retry
+    with audit_flush_lock:
+        while True:
+            events = audit_retry
+            while len(events) < AUDIT_BATCH_SIZE:
+                try:
+                    events.append(audit_buffer.get_nowait())
+                except queue.Empty:
+                    break
+            if not events:
+                return
+            try:
+                try:
+                    write_audit_batch(events)
+                    written = len(events)
+                except (psycopg2.DataError, psycopg2.IntegrityError):
+                    # Erro nos dados (não transitório): repetir o lote falharia sempre
+                    written = write_audit_rows(events)
+            except Exception as e:
+                # O lote fica guardado; enquanto a base de dados falhar, o 'buffer' enche e os
+                # pedidos passam a descartar eventos
+                audit_retry = events
+                with audit_lock:
+                    audit_counters["failed_flushes"] += 1
+                logging.getLogger('logger').warning(f'Audit flush failed ({len(events)} events kept): {e}')
+                return
+            audit_retry = []
+            with audit_lock:
+                audit_counters["written"] += written
+                audit_counters["rejected"] += len(events) - written
+
+
+def audit_flusher():
+    while True:
+        audit_wakeup.wait(AUDIT_FLUSH_INTERVAL)
+        audit_wakeup.clear()
+        try:
+            flush_audit_events()
+        except Exception as e:
+            logging.getLogger('logger').warning(f'Audit flusher error: {e}')
+
+
+def start_audit_flusher():
+    global audit_flusher_started
+    with audit_lock:
+        if audit_flusher_started:
+            return
+        audit_flusher_started = True
+    threading.Thread(target=audit_flusher, daemon=True).start()
+
+
+def audit_metrics():
+    with audit_lock:
+        metrics = dict(audit_counters)
+    metrics["queued"] = audit_buffer.qsize() + len(audit_retry)
+    metrics["capacity"] = AUDIT_BUFFER_SIZE
+    return metrics
+
+
+# Eventos ainda em memória são escritos quando o processo termina
+atexit.register(flush_audit_events)
+
+
+@app.route('/dbproj/audit/metrics', methods=['GET'])
+@jwt_required()
+def audit_metrics_endpoint():
+    # Métricas locais do processo; a ligação serve apenas para verificar o perfil do utilizador
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    try:
+        execute_prepared(cur, 'is_assistant', (current_user,))
+        if cur.fetchone() is None:
+            return jsonify({"msg": "Access denied. Only assistants can see audit metrics."}), 400
+    finally:
+        cur.close()
+        db.close()
+
+    return jsonify({"status": 200, "results": audit_metrics()}), 200
+
+
 ##########################################################
 # START ENDPOINT
 ##########################################################
@@ -57,6 +669,8 @@ def landing_page():
 def validate_username(username):
     if not match(r'^[a-zA-Z0-9]+$', username):
         return "Username must contain only letters and numbers"
+    if len(username) > 512:
+        return "Username must have at most 512 characters"
     return None
 
 
@@ -107,6 +721,183 @@ def validate_id(check_id):
     return None
 
 
+def validate_positive_integer(value):
+    if not str(value).isdigit() or int(value) == 0:
+        return "Must be a positive integer"
+    return None
+
+
+def validate_nurse_entry(nurse):
+    # Cada enfermeiro é indicado como [username, ...]
+    if not nurse or not isinstance(nurse[0], str):
+        return "Nurse must be given as [username, ...]"
+    return validate_username(nurse[0])
+
+
+def month_bounds(day):
+    # Intervalo [primeiro dia do mês, primeiro dia do mês seguinte) - permite 'partition pruning'
+    first_day = day.replace(day=1)
+    next_first_day = (first_day + timedelta(days=32)).replace(day=1)
+    return first_day, next_first_day
+
+
+def one_year_before(day):
+    try:
+        return day.replace(year=day.year - 1)
+    except ValueError:
+        # 29 de fevereiro
+        return day.replace(year=day.year - 1, day=28)
+
+
+##########################################################
+# REQUEST SCHEMAS
+##########################################################
+# Esquemas declarativos do corpo dos pedidos: validados antes de qualquer acesso à base de dados,
+# devolvendo todos os erros de uma só vez
+def field(*validators, required=True, kind=str, choices=None, schema=None, items=None):
+    return {"validators": validators, "required": required, "kind": kind, "choices": choices,
+            "schema": schema, "items": items}
+
+
+KIND_NAMES = {str: "a string", int: "an integer", list: "a list", dict: "an object"}
+
+
+def compile_field(spec):
+    kinds = spec["kind"] if isinstance(spec["kind"], tuple) else (spec["kind"],)
+    nested = compile_schema(spec["schema"]) if spec["schema"] is not None else None
+    item_check = compile_field(spec["items"]) if spec["items"] is not None else None
+
+    def check(value, path, errors):
+        if value is None or value == '' or value == [] or value == {}:
+            if spec["required"]:
+                errors[path] = "Missing required field"
+            return
+        if not isinstance(value, kinds) or isinstance(value, bool):
+            errors[path] = "Must be " + " or ".join(KIND_NAMES[k] for k in kinds)
+            return
+        if spec["choices"] is not None and value not in spec["choices"]:
+            errors[path] = "Must be one of: " + ", ".join(spec["choices"])
+            return
+        for validator in spec["validators"]:
+            validation_error = validator(value)
+            if validation_error:
+                errors[path] = validation_error
+                return
+        if nested is not None:
+            nested(value, path + '.', errors)
+        if item_check is not None:
+            for index, item in enumerate(value):
+                item_check(item, f'{path}[{index}]', errors)
+
+    return check
+
+
+def compile_schema(schema):
+    checks = [(name, compile_field(spec)) for name, spec in schema.items()]
+
+    def check(body, prefix, errors):
+        for name, field_check in checks:
+            field_check(body.get(name), prefix + name, errors)
+
+    return check
+
+
+def validate_body(schema):
+    # O esquema é compilado uma única vez, quando a rota é definida
+    check = compile_schema(schema)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not request.is_json:
+                return jsonify({"msg": "Missing JSON in request"}), 400
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                return jsonify({"msg": "Request body must be a JSON object"}), 400
+            errors = {}
+            check(body, '', errors)
+            if errors:
+                return jsonify({"msg": "Invalid request body", "errors": errors}), 400
+            return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+COMMON_USER_SCHEMA = {
+    'username': field(validate_username),
+    'password': field(),
+    'name': field(validate_name),
+    'mobile_number': field(validate_mobile_number, kind=(str, int)),
+    'birth_date': field(validate_date_format),
+    'address': field(),
+    'email': field(validate_email),
+}
+
+CONTRACT_SCHEMA = {
+    'salary': field(validate_salary, kind=(str, int)),
+    'start_date': field(validate_date_format),
+    'duration': field(required=False, kind=(str, int)),
+    'end_date': field(validate_date_format, required=False),
+}
+
+EMPLOYEE_SCHEMA = {**COMMON_USER_SCHEMA, 'contract': field(kind=dict, schema=CONTRACT_SCHEMA)}
+
+NURSE_SCHEMA = {**EMPLOYEE_SCHEMA, 'position': field()}
+
+DOCTOR_SCHEMA = {
+    **EMPLOYEE_SCHEMA,
+    'license_info': field(),
+    'specializations_ids': field(required=False, kind=list, items=field(validate_id, kind=(str, int))),
+}
+
+LOGIN_SCHEMA = {
+    'username': field(),
+    'password': field(),
+}
+
+APPOINTMENT_SCHEMA = {
+    'doctor_id': field(),
+    'date': field(validate_date_time_format),
+    'duration': field(validate_positive_integer, required=False, kind=(str, int)),
+}
+
+SURGERY_SCHEMA = {
+    'patient_id': field(validate_username),
+    'doctor': field(validate_username),
+    'nurses': field(kind=list, items=field(validate_nurse_entry, kind=list)),
+    'date': field(validate_date_time_format),
+    'duration': field(validate_positive_integer, required=False, kind=(str, int)),
+}
+
+MEDICINE_SCHEMA = {
+    'medicine': field(),
+    'posology_dose': field(validate_positive_integer, kind=(str, int)),
+    'posology_frequency': field(validate_positive_integer, kind=(str, int)),
+}
+
+PRESCRIPTION_SCHEMA = {
+    'type': field(choices=('hospitalization', 'appointment')),
+    'event_id': field(validate_id, kind=(str, int)),
+    'validity': field(validate_date_format),
+    'medicines': field(kind=list, items=field(kind=dict, schema=MEDICINE_SCHEMA)),
+}
+
+SCREENING_SCHEMA = {
+    'medicines': field(kind=list, items=field()),
+}
+
+PAYMENT_SCHEMA = {
+    'amount': field(validate_positive_integer, kind=(str, int)),
+    'payment_method': field(),
+}
+
+REPORT_JOB_SCHEMA = {
+    'type': field(choices=('monthly_report', 'daily_summary')),
+    'date': field(validate_date_format, required=False),
+}
+
+
 ##########################################################
 # GET COMMON USER DATA
 ##########################################################
@@ -284,10 +1075,8 @@ def contract_check(username, contract_data):
 # ADD PATIENT
 ##########################################################
 @app.route('/dbproj/register/patient', methods=['POST'])
+@validate_body(COMMON_USER_SCHEMA)
 def register_patient():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Adicionar os dados comuns do user
     data = request.get_json()
     username, status = get_common_user_data(data)
@@ -316,10 +1105,8 @@ def register_patient():
 # ADD ASSISTANT
 ##########################################################
 @app.route('/dbproj/register/assistant', methods=['POST'])
+@validate_body(EMPLOYEE_SCHEMA)
 def register_assistant():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Adicionar os dados comuns do user
     data = request.get_json()
     username, status = get_common_user_data(data)
@@ -354,15 +1141,11 @@ def register_assistant():
 # ADD NURSE
 ##########################################################
 @app.route('/dbproj/register/nurse', methods=['POST'])
+@validate_body(NURSE_SCHEMA)
 def register_nurse():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Adicionar os dados do enfermeiro
     data = request.get_json()
     position = data.get('position', None)
-    if not position:
-        return jsonify({"msg": "Missing required field: position"}), 400
 
     # Adicionar os dados comuns do user
     username, status = get_common_user_data(data)
@@ -397,23 +1180,17 @@ def register_nurse():
 # ADD DOCTOR
 ##########################################################
 @app.route('/dbproj/register/doctor', methods=['POST'])
+@validate_body(DOCTOR_SCHEMA)
 def register_doctor():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Adicionar os dados do médico
     data = request.get_json()
-    db = db_connection()
-    cur = db.cursor()
     doctor_license = data.get('license_info', None)
-    if not doctor_license:
-        return jsonify({"msg": "Missing required field: license_info"}), 400
     specializations = data.get('specializations_ids', [])
-    if not specializations:
-        return jsonify({"msg": "At least one specialization must be specified"}), 400
+
+    # Conectar à base de dados e verificar as especializações
+    db = db_connection()
+    cur = db.cursor()
     for specialization_id in specializations:
-        if not str(specialization_id).isdigit():
-            return jsonify({"msg": "Specialization ID must contain only digits"}), 400
         cur.execute('SELECT 1 FROM specializations WHERE specialization_id = %s', (specialization_id,))
         if cur.fetchone() is None:
             return jsonify({"msg": f"Specialization ID {specialization_id} does not exist"}), 400
@@ -455,22 +1232,17 @@ def register_doctor():
 # LOGIN
 ##########################################################
 @app.route('/dbproj/user', methods=['PUT'])
+@validate_body(LOGIN_SCHEMA)
 def login():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Obter username e password
     username = request.json.get('username', None)
     password = request.json.get('password', None)
 
-    if not username or not password:
-        return jsonify({"msg": "Missing username or password"}), 400
-
     # Conectar à base de dados e procurar o utilizador
     db = db_connection()
     cur = db.cursor()
     try:
-        cur.execute('SELECT password FROM person WHERE username = %s', (username,))
+        execute_prepared(cur, 'login_password', (username,))
         user = cur.fetchone()
         if user is None:
             return jsonify({"msg": "Username not found"}), 400
@@ -487,15 +1259,32 @@ def login():
         db.close()
 
 
+##########################################################
+# SCHEDULE CONFLICTS
+##########################################################
+# Duração por omissão (minutos) das marcações sem 'duration'
+APPOINTMENT_DEFAULT_MINUTES = 30
+SURGERY_DEFAULT_MINUTES = 120
+
+# Restrições de exclusão de schedule_slots (intervalos sobrepostos) e mensagem devolvida
+SCHEDULE_CONFLICTS = {
+    'schedule_slots_doctor_overlap': "Doctor is not available at the given date and time",
+    'schedule_slots_nurse_overlap': "Nurse is not available at the given date and time",
+    'schedule_slots_patient_overlap': "Patient already has an appointment scheduled at the given date and time",
+}
+
+
+def schedule_conflict_message(error):
+    return SCHEDULE_CONFLICTS.get(error.diag.constraint_name, "Schedule conflict at the given date and time")
+
+
 ##########################################################
 # SCHEDULE APPOINTMENT
 ##########################################################
 @app.route('/dbproj/appointment', methods=['POST'])
 @jwt_required()
+@validate_body(APPOINTMENT_SCHEMA)
 def schedule_appointment():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Conectar à base de dados
     db = db_connection()
     cur = db.cursor()
@@ -504,62 +1293,39 @@ def schedule_appointment():
     patient_user = get_jwt_identity()
 
     # Verificar se o utilizador é um paciente
-    cur.execute("SELECT 1 FROM patient WHERE LOWER(person_username) = LOWER(%s)", (patient_user,))
+    execute_prepared(cur, 'is_patient', (patient_user,))
     is_patient = cur.fetchone()
     if is_patient is None:
         return jsonify({"msg": "Access denied. Only patients can schedule appointments."}), 400
 
     # Obter o 'id' do médico para o qual o paciente quer marcar a consulta
     doctor_user = request.json.get('doctor_id')
-    cur.execute("SELECT 1 FROM doctors WHERE LOWER(employee_contract_person_username) = LOWER(%s)", (doctor_user,))
+    execute_prepared(cur, 'is_doctor', (doctor_user,))
     doctor = cur.fetchone()
     if doctor is None:
         return jsonify({"msg": "Doctor not found"}), 400
 
-    # Obter a data e hora da consulta
+    # Obter a data, hora e duração (minutos) da consulta
     date = request.json.get('date')
-    if date is not None:
-        validation_error = validate_date_time_format(date)
-        if validation_error:
-            return jsonify({"msg": validation_error}), 400
+    duration = int(request.json.get('duration') or APPOINTMENT_DEFAULT_MINUTES)
 
-    if not doctor_user or not date:
-        return jsonify({"msg": "All fields are required"}), 400
-
-    # Verificar se o médico está disponível na data e hora pretendida
-    cur.execute("""
-        SELECT 1 
-        FROM appointments
-        WHERE LOWER(doctors_employee_contract_person_username) = LOWER(%s) 
-        AND appointment_date = %s
-    """, (doctor_user, date))
-    appointment_exists = cur.fetchone()
-    if appointment_exists is not None:
-        return jsonify({"msg": "Doctor is not available at the given date and time"}), 400
-
-    # Verificar se o paciente já tem uma consulta marcada para a data e hora pretendida
-    cur.execute("""
-            SELECT 1 
-            FROM appointments
-            WHERE LOWER(patient_person_username) = LOWER(%s) 
-            AND appointment_date = %s
-        """, (patient_user, date))
-    appointment_exists = cur.fetchone()
-    if appointment_exists is not None:
-        return jsonify({"msg": "Patient already has an appointment scheduled at the given date and time"}), 400
-
-    # Marcar a consulta
+    # Marcar a consulta: a disponibilidade do médico e do paciente é garantida pelas
+    # restrições de exclusão de schedule_slots
     try:
         cur.execute("""
                     INSERT INTO appointments (
                         appointment_date, 
                         patient_person_username, 
-                        doctors_employee_contract_person_username
-                    ) VALUES (%s, %s, %s) RETURNING appointment_id
-                """, (date, patient_user, doctor_user))
+                        doctors_employee_contract_person_username,
+                        duration
+                    ) VALUES (%s, %s, %s, make_interval(mins => %s)) RETURNING appointment_id
+                """, (date, patient_user, doctor_user, duration))
         appointment_id = cur.fetchone()[0]
         db.commit()
         return jsonify({"status": 200, "results": appointment_id}), 200
+    except psycopg2.errors.ExclusionViolation as e:
+        db.rollback()
+        return jsonify({"msg": schedule_conflict_message(e)}), 400
     except Exception as e:
         db.rollback()
         return jsonify({"status": 500, "errors": str(e)}), 500
@@ -574,39 +1340,46 @@ def schedule_appointment():
 @app.route('/dbproj/appointments/<int:patient_user_id>', methods=['GET'])
 @jwt_required()
 def see_appointments(patient_user_id):
-    # Conectar à base de dados
-    db = db_connection()
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
     cur = db.cursor()
 
     # Obter o nome do paciente ou assistente que está a fazer o pedido
     current_user = get_jwt_identity()
 
     # Verificar se o utilizador é um paciente ou um assistente
-    cur.execute("SELECT 1 FROM patient WHERE LOWER(person_username) = LOWER(%s)", (current_user,))
+    execute_prepared(cur, 'is_patient', (current_user,))
     is_patient = cur.fetchone()
     if is_patient is None:
-        cur.execute("SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER(%s)",
-                    (current_user,))
+        execute_prepared(cur, 'is_assistant', (current_user,))
         is_assistant = cur.fetchone()
         if is_assistant is None:
             return jsonify({"msg": "Access denied. Only assistants/target patient can see appointments."}), 400
 
-    # Obter username do paciente a consultar
-    cur.execute("SELECT person_username FROM patient WHERE patient_id = %s", (patient_user_id,))
-    patient_name_result = cur.fetchone()
+    # Obter username do paciente a consultar e a versão atual das suas consultas
+    patient_name_result = get_patient_version(cur, patient_user_id)
     if patient_name_result is None:
         return jsonify({"msg": "Patient not found"}), 400
-    patient_name = patient_name_result[0]
+    patient_name, version = patient_name_result
+    record_access(current_user, patient_name, 'appointments', 'read')
+
+    # Se o cliente já tem a versão atual, responder 304 sem executar a query completa
+    etag = patient_etag('appointments', patient_user_id, version)
+    cached = not_modified(etag)
+    if cached is not None:
+        cur.close()
+        db.close()
+        return cached
 
-    # Devolver as consultas marcadas para o paciente
+    # Devolver as consultas marcadas para o paciente (documento JSON construído pelo Postgres)
     try:
-        cur.execute('''SELECT appointment_id, doctors_employee_contract_person_username, appointment_date
-                       FROM appointments WHERE LOWER(patient_person_username) = LOWER(%s)''', (patient_name,))
-        appointments = cur.fetchall()
-        if appointments is None:
-            return jsonify({"msg": "No appointments found"}), 400
-        results = [{"id": appt[0], "doctor_id": appt[1], "date": appt[2]} for appt in appointments]
-        return jsonify({"status": 200, "results": results}), 200
+        return with_etag(json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', COALESCE(json_agg(json_build_object(
+                       'id', appointment_id,
+                       'doctor_id', doctors_employee_contract_person_username,
+                       'date', appointment_date)), '[]'::json))::text
+            FROM appointments WHERE LOWER(patient_person_username) = LOWER(%s)
+        ''', (patient_name,)), etag)
     finally:
         cur.close()
         db.close()
@@ -618,10 +1391,8 @@ def see_appointments(patient_user_id):
 @app.route('/dbproj/surgery', methods=['POST'])
 @app.route('/dbproj/surgery/<int:hospitalization_id>', methods=['POST'])
 @jwt_required()
+@validate_body(SURGERY_SCHEMA)
 def schedule_surgery(hospitalization_id=None):
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
-
     # Conectar à base de dados
     db = db_connection()
     cur = db.cursor()
@@ -630,59 +1401,33 @@ def schedule_surgery(hospitalization_id=None):
     current_user = get_jwt_identity()
 
     # Verificar se o utilizador é um assistente
-    cur.execute('SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (current_user,))
+    execute_prepared(cur, 'is_assistant', (current_user,))
     is_assistant = cur.fetchone()
     if is_assistant is None:
         return jsonify({"msg": "Access denied. Only assistants can schedule surgeries."}), 400
 
     # Obter os dados da cirurgia
     patient_id = request.json.get('patient_id')
-    validation_error = validate_username(patient_id)
-    if validation_error:
-        return jsonify({"msg": validation_error}), 400
-    cur.execute('SELECT 1 FROM patient WHERE LOWER(person_username) = LOWER(%s)', (patient_id,))
+    execute_prepared(cur, 'is_patient', (patient_id,))
     patient_exists = cur.fetchone()
     if patient_exists is None:
         return jsonify({"msg": "Patient not found"}), 400
 
     doctor = request.json.get('doctor')
-    validation_error = validate_username(doctor)
-    if validation_error:
-        return jsonify({"msg": validation_error}), 400
-    cur.execute('SELECT 1 FROM doctors WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (doctor,))
+    execute_prepared(cur, 'is_doctor', (doctor,))
     doctor_exists = cur.fetchone()
     if doctor_exists is None:
         return jsonify({"msg": "Doctor not found"}), 400
 
     nurses = request.json.get('nurses')
     for nurse in nurses:
-        validation_error = validate_username(nurse[0])
-        if validation_error:
-            return jsonify({"msg": validation_error}), 400
-        cur.execute('SELECT 1 FROM nurses WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (nurse[0],))
+        execute_prepared(cur, 'is_nurse', (nurse[0],))
         nurse_exists = cur.fetchone()
         if nurse_exists is None:
             return jsonify({"msg": "Nurse not found"}), 400
 
     date = request.json.get('date')
-    if date is not None:
-        validation_error = validate_date_time_format(date)
-        if validation_error:
-            return jsonify({"msg": validation_error}), 400
-
-    if not patient_id or not doctor or not nurses or not date:
-        return jsonify({"msg": "All fields are required"}), 400
-
-    # Verificar se o médico está disponível na data e hora pretendida
-    cur.execute("""
-        SELECT 1 
-        FROM surgeries
-        WHERE LOWER(doctors_employee_contract_person_username) = LOWER(%s) 
-        AND surgery_date = %s
-    """, (doctor, date))
-    surgery_exists = cur.fetchone()
-    if surgery_exists is not None:
-        return jsonify({"msg": "Doctor is not available at the given date and time"}), 400
+    duration = int(request.json.get('duration') or SURGERY_DEFAULT_MINUTES)
 
     # Verificar se o 'id' de hospitalização é válido
     if hospitalization_id is not None:
@@ -705,10 +1450,12 @@ def schedule_surgery(hospitalization_id=None):
                          end_date_obj.strftime('%Y-%m-%d %H:%M:%S'), patient_id, current_user, nurses[0][0]))
             hospitalization_id = cur.fetchone()[0]
 
-        # Inserir a cirurgia
+        # Inserir a cirurgia: a disponibilidade do médico e dos enfermeiros é garantida pelas
+        # restrições de exclusão de schedule_slots
         cur.execute('''INSERT INTO surgeries (surgery_date, hospitalizations_hospitalization_id, 
-        doctors_employee_contract_person_username) VALUES (%s, %s, %s) RETURNING surgery_id''',
-                    (date, hospitalization_id, doctor))
+        doctors_employee_contract_person_username, duration)
+        VALUES (%s, %s, %s, make_interval(mins => %s)) RETURNING surgery_id''',
+                    (date, hospitalization_id, doctor, duration))
         surgery_id = cur.fetchone()[0]
 
         # Inserir os enfermeiros associados à cirurgia
@@ -719,7 +1466,10 @@ def schedule_surgery(hospitalization_id=None):
         db.commit()
         return jsonify({"status": 200, "results": {"hospitalization_id": hospitalization_id, "surgery_id": surgery_id,
                                                    "patient_id": patient_id, "doctor_id": doctor,
-                                                   "date": date}}), 200
+                                                   "date": date, "duration": duration}}), 200
+    except psycopg2.errors.ExclusionViolation as e:
+        db.rollback()
+        return jsonify({"msg": schedule_conflict_message(e)}), 400
     except Exception as e:
         db.rollback()
         return jsonify({"status": 500, "errors": str(e)}), 500
@@ -734,100 +1484,189 @@ def schedule_surgery(hospitalization_id=None):
 @app.route('/dbproj/prescriptions/<int:person_id>', methods=['GET'])
 @jwt_required()
 def get_prescriptions(person_id):
-    # Conectar à base de dados
-    db = db_connection()
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
     cur = db.cursor()
 
-    # Verificar se o 'id' do paciente é válido
-    cur.execute('SELECT person_username FROM patient WHERE patient_id = %s', (person_id,))
-    patient_exists = cur.fetchone()
+    # Verificar se o 'id' do paciente é válido e obter a versão atual das suas prescrições
+    patient_exists = get_patient_version(cur, person_id)
     if patient_exists is None:
         return jsonify({"msg": "Patient not found"}), 400
-    patient_username = patient_exists[0]
+    patient_username, version = patient_exists
+    record_access(get_jwt_identity(), patient_username, 'prescriptions', 'read')
+
+    # Se o cliente já tem a versão atual, responder 304 sem executar a query completa
+    etag = patient_etag('prescriptions', person_id, version)
+    cached = not_modified(etag)
+    if cached is not None:
+        cur.close()
+        db.close()
+        return cached
 
     try:
-        cur.execute('''
-                   SELECT p.prescription_id, p.prescription_date, pos.dosage, pos.frequency, m.medicine_name
-                   FROM prescriptions p
-                   JOIN hospitalizations_prescriptions hp ON p.prescription_id = hp.prescriptions_prescription_id
-                   JOIN hospitalizations h ON hp.hospitalizations_hospitalization_id = h.hospitalization_id
-                   JOIN posology pos ON p.prescription_id = pos.prescriptions_prescription_id
-                   JOIN medicines m ON pos.medicines_medicine_name = m.medicine_name
-                   WHERE h.patient_person_username = %s
-                   UNION
-                   SELECT p.prescription_id, p.prescription_date, pos.dosage, pos.frequency, m.medicine_name
-                   FROM prescriptions p
-                   JOIN appointments_prescriptions ap ON p.prescription_id = ap.prescriptions_prescription_id
-                   JOIN appointments a ON ap.appointments_appointment_id = a.appointment_id
-                   JOIN posology pos ON p.prescription_id = pos.prescriptions_prescription_id
-                   JOIN medicines m ON pos.medicines_medicine_name = m.medicine_name
-                   WHERE a.patient_person_username = %s
-               ''', (patient_username, patient_username))
-
-        prescriptions = cur.fetchall()
-        results = [
-            {
-                "id": pres[0],
-                "validity": pres[1],
-                "posology": [
-                    {
-                        "dose": pres[2],
-                        "frequency": pres[3],
-                        "medicine": pres[4]
-                    }
-                ]
-            }
-            for pres in prescriptions
-        ]
-        return jsonify({"status": 200, "results": results}), 200
+        return with_etag(json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', COALESCE(json_agg(json_build_object(
+                       'id', r.prescription_id,
+                       'validity', r.prescription_date,
+                       'posology', json_build_array(json_build_object(
+                           'dose', r.dosage,
+                           'frequency', r.frequency,
+                           'medicine', r.medicine_name)))), '[]'::json))::text
+            FROM (
+                SELECT p.prescription_id, p.prescription_date, pos.dosage, pos.frequency, m.medicine_name
+                FROM prescriptions p
+                JOIN hospitalizations_prescriptions hp ON p.prescription_id = hp.prescriptions_prescription_id
+                JOIN hospitalizations h ON hp.hospitalizations_hospitalization_id = h.hospitalization_id
+                JOIN posology pos ON p.prescription_id = pos.prescriptions_prescription_id
+                JOIN medicines m ON pos.medicines_medicine_name = m.medicine_name
+                WHERE h.patient_person_username = %s
+                UNION
+                SELECT p.prescription_id, p.prescription_date, pos.dosage, pos.frequency, m.medicine_name
+                FROM prescriptions p
+                JOIN appointments_prescriptions ap ON p.prescription_id = ap.prescriptions_prescription_id
+                JOIN appointments a ON ap.appointments_appointment_id = a.appointment_id
+                JOIN posology pos ON p.prescription_id = pos.prescriptions_prescription_id
+                JOIN medicines m ON pos.medicines_medicine_name = m.medicine_name
+                WHERE a.patient_person_username = %s
+            ) r
+        ''', (patient_username, patient_username)), etag)
     finally:
         cur.close()
         db.close()
 
 
 ##########################################################
-# ADD PRESCRIPTIONS
+# SIDE-EFFECT SCREENING
 ##########################################################
-@app.route('/dbproj/prescription/', methods=['POST'])
-@jwt_required()
-def add_prescription():
-    if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
+# Índice em memória: nome do medicamento (minúsculas) -> (nome, [(efeito secundário, intensidade)]).
+# É carregado no primeiro uso e marcado como desatualizado quando os triggers de medicines e
+# severity notificam uma alteração, pelo que a triagem não faz pedidos à base de dados.
+SIDE_EFFECTS_CHANNEL = 'side_effects_changed'
 
-    # Conectar à base de dados
-    db = db_connection()
-    cur = db.cursor()
-
-    # Obter os dados da prescrição
-    req_type = request.json.get('type')  # "hospitalization" or "appointment"
-    if req_type not in ['hospitalization', 'appointment']:
-        return jsonify({"msg": "Invalid request type"}), 400
-
-    event_id = request.json.get('event_id')
-    if not str(event_id).isdigit():
-        return jsonify({"msg": "Event ID must contain only digits"}), 400
+side_effect_index = {"medicines": None, "generation": 0, "loaded_generation": -1}
+side_effect_lock = threading.Lock()
 
-    validity = request.json.get('validity')
-    validation_error = validate_date_format(validity)
-    if validation_error:
-        return jsonify({"msg": validation_error}), 400
 
-    medicines = request.json.get('medicines')
-    for med in medicines:
-        cur.execute('SELECT 1 FROM medicines WHERE LOWER(medicine_name) = LOWER(%s)', (med.get('medicine'),))
-        med_exists = cur.fetchone()
-        if med_exists is None:
-            return jsonify({"msg": "Medicine not found"}), 400
+def invalidate_side_effect_index(payload=None):
+    with side_effect_lock:
+        side_effect_index["generation"] += 1
 
-    if not req_type or not event_id or not validity or not medicines:
-        return jsonify({"msg": "All fields are required"}), 400
 
-    current_user = get_jwt_identity()
+listen_channel(SIDE_EFFECTS_CHANNEL, invalidate_side_effect_index, invalidate_side_effect_index)
 
-    # Verificar se o utilizador é um médico
-    cur.execute('SELECT 1 FROM doctors WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (current_user,))
-    if not cur.fetchone():
-        return jsonify({"msg": "Only doctors can add prescriptions"}), 400
+
+def load_side_effect_index():
+    db = db_connection()
+    if isinstance(db, tuple):
+        raise RuntimeError(db[0]["msg"])
+    cur = db.cursor()
+    try:
+        cur.execute('''
+            SELECT m.medicine_name, s.side_effects_side_effect, s.intensity
+            FROM medicines m
+            LEFT JOIN severity s ON s.medicines_medicine_name = m.medicine_name
+            ORDER BY m.medicine_name, s.intensity DESC NULLS LAST, s.side_effects_side_effect
+        ''')
+        medicines = {}
+        for medicine_name, side_effect, intensity in cur.fetchall():
+            entry = medicines.setdefault(medicine_name.lower(), (medicine_name, []))
+            if side_effect is not None:
+                entry[1].append((side_effect, intensity))
+        return medicines
+    finally:
+        cur.close()
+        db.close()
+
+
+def get_side_effect_index():
+    start_notification_listener()
+    with side_effect_lock:
+        generation = side_effect_index["generation"]
+        if side_effect_index["loaded_generation"] == generation:
+            return side_effect_index["medicines"]
+    medicines = load_side_effect_index()
+    with side_effect_lock:
+        # Só fica atual se não houve alterações durante o carregamento
+        side_effect_index["medicines"] = medicines
+        side_effect_index["loaded_generation"] = generation
+    return medicines
+
+
+def screen_medicines(names):
+    # Devolve (resultado da triagem, medicamentos desconhecidos)
+    index = get_side_effect_index()
+    unknown = [name for name in names if name.lower() not in index]
+    if unknown:
+        return None, unknown
+
+    per_medicine = []
+    side_effects = {}
+    for name in dict.fromkeys(name.lower() for name in names):
+        medicine_name, effects = index[name]
+        intensities = [intensity for _, intensity in effects if intensity is not None]
+        per_medicine.append({"medicine": medicine_name,
+                             "max_intensity": max(intensities, default=None),
+                             "side_effects": [{"side_effect": side_effect, "intensity": intensity}
+                                              for side_effect, intensity in effects]})
+        for side_effect, intensity in effects:
+            aggregated = side_effects.setdefault(side_effect, {"side_effect": side_effect, "intensity": intensity,
+                                                               "medicines": []})
+            if intensity is not None and (aggregated["intensity"] is None or intensity > aggregated["intensity"]):
+                aggregated["intensity"] = intensity
+            aggregated["medicines"].append(medicine_name)
+
+    aggregated = sorted(side_effects.values(), key=lambda e: (e["intensity"] is None, -(e["intensity"] or 0),
+                                                              e["side_effect"]))
+    intensities = [e["intensity"] for e in aggregated if e["intensity"] is not None]
+    return {"max_intensity": max(intensities, default=None), "side_effects": aggregated,
+            "medicines": per_medicine}, []
+
+
+@app.route('/dbproj/prescription/check', methods=['POST'])
+@jwt_required()
+@validate_body(SCREENING_SCHEMA)
+def check_prescription():
+    try:
+        screening, unknown = screen_medicines(request.json.get('medicines'))
+    except Exception as e:
+        return jsonify({"status": 500, "errors": str(e)}), 500
+    if unknown:
+        return jsonify({"msg": "Medicine not found", "medicines": unknown}), 400
+    return jsonify({"status": 200, "results": screening}), 200
+
+
+##########################################################
+# ADD PRESCRIPTIONS
+##########################################################
+@app.route('/dbproj/prescription/', methods=['POST'])
+@jwt_required()
+@validate_body(PRESCRIPTION_SCHEMA)
+def add_prescription():
+    # Obter os dados da prescrição
+    req_type = request.json.get('type')  # "hospitalization" or "appointment"
+    event_id = request.json.get('event_id')
+    validity = request.json.get('validity')
+    medicines = request.json.get('medicines')
+
+    # Triagem de efeitos secundários (índice em memória, também valida os medicamentos)
+    try:
+        screening, unknown = screen_medicines([med.get('medicine') for med in medicines])
+    except Exception as e:
+        return jsonify({"status": 500, "errors": str(e)}), 500
+    if unknown:
+        return jsonify({"msg": "Medicine not found", "medicines": unknown}), 400
+    medicine_names = {entry["medicine"].lower(): entry["medicine"] for entry in screening["medicines"]}
+
+    # Conectar à base de dados
+    db = db_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um médico
+    execute_prepared(cur, 'is_doctor', (current_user,))
+    if not cur.fetchone():
+        return jsonify({"msg": "Only doctors can add prescriptions"}), 400
 
     try:
         # Inserir prescrição
@@ -836,7 +1675,7 @@ def add_prescription():
 
         # Inserir posologia e eventos associados
         for medicine in medicines:
-            medicine_name = medicine.get('medicine')
+            medicine_name = medicine_names[medicine.get('medicine').lower()]
             posology_dose = medicine.get('posology_dose')
             posology_frequency = medicine.get('posology_frequency')
 
@@ -855,7 +1694,8 @@ def add_prescription():
                 'INSERT INTO appointments_prescriptions (appointments_appointment_id, prescriptions_prescription_id) '
                 'VALUES (%s, %s)', (event_id, prescription_id))
         db.commit()
-        return jsonify({"status": 200, "results": {"prescription_id": prescription_id}}), 200
+        return jsonify({"status": 200, "results": {"prescription_id": prescription_id,
+                                                   "screening": screening}}), 200
     except Exception as e:
         db.rollback()
         return jsonify({"status": 500, "errors": str(e)}), 500
@@ -867,71 +1707,128 @@ def add_prescription():
 ##########################################################
 # EXECUTE PAYMENT
 ##########################################################
+# Pagamento numa única instrução: bloqueia apenas a linha da fatura, só aceita o valor se
+# não exceder o montante em falta, regista o pagamento no 'ledger' e devolve o novo valor em falta
+PAY_BILL_SQL = '''
+    WITH paid AS (
+        UPDATE bills b
+        SET amount_paid = b.amount_paid + %(amount)s,
+            payment_method = CASE WHEN b.total_price - b.amount_paid = %(amount)s
+                                  THEN %(payment_method)s ELSE b.payment_method END
+        WHERE b.bill_id = %(bill_id)s
+        AND b.patient_person_username = %(username)s
+        AND b.total_price - b.amount_paid >= %(amount)s
+        RETURNING b.bill_id, b.total_price - b.amount_paid AS remaining
+    ), ledger AS (
+        INSERT INTO payments (payment_amount, deadline_date, payment_method, bills_bill_id)
+        SELECT %(amount)s, NOW(), %(payment_method)s, bill_id FROM paid
+        RETURNING payment_id
+    )
+    SELECT paid.remaining, ledger.payment_id FROM paid CROSS JOIN ledger
+'''
+
+
+def pay_bill(cur, bill_id, username, amount, payment_method):
+    cur.execute(PAY_BILL_SQL, {"bill_id": bill_id, "username": username,
+                               "amount": amount, "payment_method": payment_method})
+    return cur.fetchone()
+
+
 @app.route('/dbproj/bills/<int:bill_id>', methods=['POST'])
 @jwt_required()
+@validate_body(PAYMENT_SCHEMA)
 def execute_payment(bill_id):
-    # Conectar à base de dados
-    db = db_connection()
-    cur = db.cursor()
-
     current_user = get_jwt_identity()
 
     # Obter os dados do pagamento
-    amount = request.json.get('amount')
+    amount = int(request.json.get('amount'))
     payment_method = request.json.get('payment_method')
 
-    if amount is None or payment_method is None:
-        return jsonify({"status": 400, "errors": "Missing payment details"}), 400
-
-    # Verificar se o 'bill_id' é válido
-    cur.execute('SELECT 1 FROM bills WHERE bill_id = %s', (bill_id,))
-    if not cur.fetchone():
-        return jsonify({"msg": "Bill not found"}), 400
+    # Conectar à base de dados
+    db = db_connection()
+    cur = db.cursor()
 
     try:
-        # Verificar se o utilizador é o dono da fatura
-        cur.execute('''
-                    SELECT b.total_price, COALESCE(SUM(p.payment_amount), 0) AS total_paid, pa.person_username
-                    FROM bills b
-                    LEFT JOIN payments p ON b.bill_id = p.payment_id
-                    LEFT JOIN appointments_bills ab ON b.bill_id = ab.appointments_appointment_id
-                    LEFT JOIN appointments a ON ab.appointments_appointment_id = a.appointment_id
-                    LEFT JOIN patient pa ON a.patient_person_username = pa.person_username
-                    WHERE b.bill_id = %s
-                    GROUP BY b.bill_id, b.total_price, pa.person_username
-                ''', (bill_id,))
-        bill = cur.fetchone()
-
-        if not bill:
-            return jsonify({"status": 404, "errors": "Bill not found"}), 404
+        paid = pay_bill(cur, bill_id, current_user, amount, payment_method)
+        if paid is not None:
+            db.commit()
+            record_access(current_user, current_user, 'bills', 'pay', bill_id)
+            return jsonify({"status": 200, "results": paid[0]}), 200
 
-        total_price, total_paid, bill_owner = bill
+        # Pagamento recusado: identificar o motivo (caminho raro, fora do caminho principal)
+        db.rollback()
+        cur.execute('SELECT total_price - amount_paid, patient_person_username FROM bills WHERE bill_id = %s',
+                    (bill_id,))
+        bill = cur.fetchone()
+        if bill is None:
+            record_access(current_user, None, 'bills', 'pay_failed', bill_id)
+            return jsonify({"msg": "Bill not found"}), 400
 
+        # Tentativas recusadas também ficam registadas (incluindo as de outros utilizadores)
+        remaining, bill_owner = bill
         if bill_owner != current_user:
+            record_access(current_user, bill_owner, 'bills', 'pay_denied', bill_id)
             return jsonify({"status": 401, "errors": "Unauthorized"}), 401
+        record_access(current_user, bill_owner, 'bills', 'pay_failed', bill_id)
+        return jsonify({"status": 400, "errors": "Payment exceeds the remaining bill amount",
+                        "remaining": remaining}), 400
 
-        # Calcular o valor restante
-        new_remaining_value = total_price - amount
-        if new_remaining_value < 0:
-            return jsonify({"status": 400, "errors": "Payment exceeds the remaining bill amount"}), 400
+    except Exception as e:
+        db.rollback()
+        record_access(current_user, None, 'bills', 'pay_failed', bill_id)
+        return jsonify({"status": 500, "errors": str(e)}), 500
+    finally:
+        cur.close()
+        db.close()
 
-        # Inserir o pagamento
-        cur.execute('''
-                    INSERT INTO payments (payment_amount, deadline_date)
-                    VALUES (%s, NOW())
-                ''', (amount,))
 
-        # Atualizar o estado do pagamento, se totalmente pago
-        cur.execute('UPDATE bills SET total_price = %s WHERE bill_id = %s', (new_remaining_value, bill_id))
-        if new_remaining_value == 0:
-            cur.execute('UPDATE bills SET payment_method = %s WHERE bill_id = %s', (payment_method, bill_id))
+##########################################################
+# LIST BILLS
+##########################################################
+@app.route('/dbproj/bills', methods=['GET'])
+@jwt_required()
+def list_bills():
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
 
-        db.commit()
-        return jsonify({"status": 200, "results": new_remaining_value}), 200
+    # Os pacientes veem as suas faturas; os assistentes podem indicar o paciente ('?patient=')
+    patient_user = request.args.get('patient', current_user)
+    validation_error = validate_username(patient_user)
+    if validation_error:
+        cur.close()
+        db.close()
+        return jsonify({"msg": validation_error}), 400
+    if patient_user.lower() != current_user.lower():
+        execute_prepared(cur, 'is_assistant', (current_user,))
+        if not cur.fetchone():
+            cur.close()
+            db.close()
+            return jsonify({"msg": "Access denied. Only assistants/target patient can see bills."}), 400
 
-    except Exception as e:
-        db.rollback()
-        return jsonify({"status": 500, "errors": str(e)}), 500
+    record_access(current_user, patient_user, 'bills', 'read')
+
+    # '?outstanding=true' devolve apenas as faturas com valor em falta
+    outstanding_only = request.args.get('outstanding', 'false').lower() in ('1', 'true', 'yes')
+
+    # Uma única query sobre o índice (patient_person_username, deadline_date)
+    try:
+        return json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', COALESCE(json_agg(json_build_object(
+                       'id', bill_id,
+                       'appointment_id', appointments_appointment_id,
+                       'hospitalization_id', hospitalizations_hospitalization_id,
+                       'total_price', total_price,
+                       'amount_paid', amount_paid,
+                       'outstanding', total_price - amount_paid,
+                       'deadline_date', deadline_date,
+                       'payment_method', payment_method) ORDER BY deadline_date), '[]'::json))::text
+            FROM bills
+            WHERE patient_person_username = %s
+            AND (NOT %s OR total_price > amount_paid)
+        ''', (patient_user, outstanding_only))
     finally:
         cur.close()
         db.close()
@@ -943,34 +1840,51 @@ def execute_payment(bill_id):
 @app.route('/dbproj/top3', methods=['GET'])
 @jwt_required()
 def list_top_three_patients():
-    # Conectar à base de dados
-    db = db_connection()
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
     cur = db.cursor()
 
     current_user = get_jwt_identity()
 
     # Verificar se o utilizador é um assistente
-    cur.execute('SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (current_user,))
+    execute_prepared(cur, 'is_assistant', (current_user,))
     if not cur.fetchone():
         return jsonify({"msg": "Only assistants can see top 3"}), 400
 
+    # Pagamentos do mês atual (intervalo de datas, para o Postgres só ler a partição do mês)
+    month_start, month_end = month_bounds(dt_date.today())
+
     try:
-        cur.execute('''
-            SELECT p.person_username, SUM(pa.payment_amount) AS total_spent, 
-                   json_agg(json_build_object('id', a.appointment_id, 
-                                              'doctor_id', a.doctors_employee_contract_person_username, 
-                                              'date', a.appointment_date)) AS procedures
-            FROM patient p 
-            LEFT JOIN appointments a ON p.person_username = a.patient_person_username
-            LEFT JOIN payments pa ON a.appointment_id = pa.payment_id
-            WHERE EXTRACT(MONTH FROM pa.deadline_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-            GROUP BY p.person_username
-            ORDER BY total_spent DESC
-            LIMIT 3
-        ''')
-        top_patients = cur.fetchall()
-        results = [{"person_username": pat[0], "amount_spent": pat[1], "procedures": pat[2]} for pat in top_patients]
-        return jsonify({"status": 200, "results": results}), 200
+        return json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', COALESCE(json_agg(json_build_object(
+                       'person_username', t.person_username,
+                       'amount_spent', t.total_spent,
+                       'procedures', t.procedures) ORDER BY t.total_spent DESC), '[]'::json))::text
+            FROM (
+                SELECT spent.person_username, spent.total_spent,
+                       (SELECT COALESCE(json_agg(json_build_object(
+                                   'id', a.appointment_id,
+                                   'doctor_id', a.doctors_employee_contract_person_username,
+                                   'date', a.appointment_date)), '[]'::json)
+                        FROM appointments a
+                        WHERE a.appointment_id IN (SELECT b.appointments_appointment_id
+                                                   FROM payments pa
+                                                   JOIN bills b ON pa.bills_bill_id = b.bill_id
+                                                   WHERE b.patient_person_username = spent.person_username
+                                                   AND pa.deadline_date >= %(month_start)s
+                                                   AND pa.deadline_date < %(month_end)s)) AS procedures
+                FROM (
+                    SELECT b.patient_person_username AS person_username, SUM(pa.payment_amount) AS total_spent
+                    FROM payments pa
+                    JOIN bills b ON pa.bills_bill_id = b.bill_id
+                    WHERE pa.deadline_date >= %(month_start)s
+                    AND pa.deadline_date < %(month_end)s
+                    GROUP BY b.patient_person_username
+                    ORDER BY total_spent DESC
+                    LIMIT 3
+                ) spent
+            ) t
+        ''', {"month_start": month_start, "month_end": month_end})
     except Exception as e:
         return jsonify({"status": 500, "errors": str(e)}), 500
     finally:
@@ -981,17 +1895,38 @@ def list_top_three_patients():
 ##########################################################
 # DAILY SUMMARY
 ##########################################################
+# Resumo das hospitalizações iniciadas num dia (devolve o JSON de 'results')
+DAILY_SUMMARY_SQL = '''
+    WITH day_hospitalizations AS (
+        SELECT hospitalization_id
+        FROM hospitalizations
+        WHERE begin_date >= %(day)s::date AND begin_date < %(day)s::date + 1
+    )
+    SELECT json_build_object(
+        'amount_spent', (SELECT COALESCE(SUM(b.total_price), 0) FROM bills b
+                         WHERE b.hospitalizations_hospitalization_id IN (SELECT * FROM day_hospitalizations)),
+        'surgeries', (SELECT COUNT(*) FROM surgeries s
+                      WHERE s.hospitalizations_hospitalization_id IN (SELECT * FROM day_hospitalizations)),
+        'prescriptions', (SELECT COUNT(DISTINCT hp.prescriptions_prescription_id) FROM hospitalizations_prescriptions hp
+                          WHERE hp.hospitalizations_hospitalization_id IN (SELECT * FROM day_hospitalizations)))
+'''
+
+
+def daily_summary_params(date):
+    return {"day": date}
+
+
 @app.route('/dbproj/daily/<date>', methods=['GET'])
 @jwt_required()
 def daily_summary(date):
-    # Conectar à base de dados
-    db = db_connection()
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
     cur = db.cursor()
 
     current_user = get_jwt_identity()
 
     # Verificar se o utilizador é um assistente
-    cur.execute('SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (current_user,))
+    execute_prepared(cur, 'is_assistant', (current_user,))
     if not cur.fetchone():
         return jsonify({"msg": "Only assistants can see daily summary"}), 400
 
@@ -1002,23 +1937,9 @@ def daily_summary(date):
         except ValueError:
             return jsonify({"status": 400, "errors": "Invalid date format. Please use YYYY-MM-DD."}), 400
 
-        cur.execute('''
-            SELECT 
-                COALESCE(SUM(b.total_price), 0) as amount_spent, 
-                COUNT(DISTINCT s.surgery_id) as surgeries, 
-                COUNT(DISTINCT p.prescription_id) as prescriptions
-            FROM hospitalizations h
-            LEFT JOIN surgeries s ON h.hospitalization_id = s.hospitalizations_hospitalization_id
-            LEFT JOIN hospitalizations_prescriptions hp ON h.hospitalization_id = hp.hospitalizations_hospitalization_id
-            LEFT JOIN prescriptions p ON hp.prescriptions_prescription_id = p.prescription_id
-            LEFT JOIN bills b ON h.hospitalization_id = b.hospitalizations_hospitalization_id
-            WHERE h.entry_date = %s
-        ''', (date,))
-
-        summary = cur.fetchone()
-        results = {"amount_spent": summary[0], "surgeries": summary[1], "prescriptions": summary[2]}
-
-        return jsonify({"status": 200, "results": results}), 200
+        return json_passthrough(cur, f"""
+            SELECT json_build_object('status', 200, 'results', ({DAILY_SUMMARY_SQL}))::text
+        """, daily_summary_params(date))
     except Exception as e:
         return jsonify({"status": 500, "errors": str(e)}), 500
     finally:
@@ -1029,9 +1950,375 @@ def daily_summary(date):
 ##########################################################
 # GENERATE A MONTHLY REPORT
 ##########################################################
+# Médicos com mais cirurgias por mês, no último ano (devolve o JSON de 'results')
+MONTHLY_REPORT_SQL = '''
+    SELECT COALESCE(json_agg(json_build_object(
+               'month', r.month,
+               'doctor', r.doctor,
+               'surgeries', r.total_surgeries) ORDER BY r.month, r.total_surgeries DESC), '[]'::json)
+    FROM (
+        SELECT EXTRACT(MONTH FROM surgery_date)::int AS month,
+               doctors_employee_contract_person_username AS doctor,
+               COUNT(surgery_id) AS total_surgeries
+        FROM surgeries
+        WHERE surgery_date > %(since)s
+        GROUP BY month, doctor
+    ) r
+'''
+
+
+def monthly_report_params():
+    # Limite calculado na API (e não com 'current_date') para o 'partition pruning' ser feito no planeamento
+    return {"since": one_year_before(dt_date.today()).isoformat()}
+
+
 @app.route('/dbproj/report', methods=['GET'])
 @jwt_required()
 def generate_monthly_report():
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um assistente
+    execute_prepared(cur, 'is_assistant', (current_user,))
+    if not cur.fetchone():
+        return jsonify({"msg": "Only assistants can generate a monthly report"}), 400
+
+    try:
+        # Médicos com mais cirurgias por mês, no último ano
+        return json_passthrough(cur, f"""
+            SELECT json_build_object('status', 200, 'results', ({MONTHLY_REPORT_SQL}))::text
+        """, monthly_report_params())
+    finally:
+        cur.close()
+        db.close()
+
+
+##########################################################
+# HOSPITALIZATION OCCUPANCY
+##########################################################
+# Número de doentes internados em cada intervalo ('bucket'): varrimento dos inícios (+1) e fins (-1)
+# das hospitalizações, somados por ordem com uma 'window function'. Só lê as hospitalizações que
+# intersectam o período pedido (índice GiST hospitalizations_stay_idx).
+OCCUPANCY_SQL = """
+    WITH stays AS (
+        SELECT GREATEST(begin_date, %(from)s) AS stay_begin,
+               LEAST(COALESCE(end_date, 'infinity'), %(to)s) AS stay_end
+        FROM hospitalizations
+        WHERE tsrange(begin_date, end_date) && tsrange(%(from)s, %(to)s)
+    ), deltas AS (
+        SELECT date_trunc(%(bucket)s, stay_begin) AS bucket, 1 AS delta FROM stays
+        UNION ALL
+        SELECT date_trunc(%(bucket)s, stay_end - INTERVAL '1 microsecond') + %(step)s::interval, -1 FROM stays
+    )
+    SELECT b.bucket, (SUM(COALESCE(d.delta, 0)) OVER (ORDER BY b.bucket))::int
+    FROM generate_series(%(from)s, %(to)s - %(step)s::interval, %(step)s::interval) AS b(bucket)
+    LEFT JOIN (SELECT bucket, SUM(delta) AS delta FROM deltas GROUP BY bucket) d ON d.bucket = b.bucket
+    ORDER BY b.bucket
+"""
+
+OCCUPANCY_BUCKETS = {
+    'day': (timedelta(days=1), '1 day', '%Y-%m-%d'),
+    'hour': (timedelta(hours=1), '1 hour', '%Y-%m-%d %H:%M'),
+}
+OCCUPANCY_MAX_BUCKETS = 24 * 366
+# Canal notificado pelo trigger de hospitalizations com o intervalo de datas alterado
+OCCUPANCY_CHANNEL = 'hospitalizations_changed'
+# Meses já terminados são guardados em cache ('bucket', primeiro dia do mês) -> [(início, internados)]
+OCCUPANCY_CACHE_MAX_MONTHS = 240
+
+occupancy_cache = {}
+occupancy_state = {"generation": 0}
+occupancy_lock = threading.Lock()
+
+
+def invalidate_occupancy(payload=None):
+    # Remove da cache os meses que intersectam o intervalo alterado (ou toda a cache)
+    try:
+        changed = json.loads(payload) if payload else None
+        changed_from = dt_date.fromisoformat(changed['from']).replace(day=1)
+        changed_to = None if changed['to'] == 'infinity' else dt_date.fromisoformat(changed['to'])
+    except (ValueError, TypeError, KeyError):
+        changed = None
+    with occupancy_lock:
+        occupancy_state["generation"] += 1
+        if changed is None:
+            occupancy_cache.clear()
+            return
+        for key in [key for key in occupancy_cache
+                    if key[1] >= changed_from and (changed_to is None or key[1] <= changed_to)]:
+            del occupancy_cache[key]
+
+
+listen_channel(OCCUPANCY_CHANNEL, invalidate_occupancy, invalidate_occupancy)
+
+
+def occupancy_months(start, end):
+    # Primeiros dias dos meses que intersectam [start, end)
+    months = []
+    month = start.date().replace(day=1)
+    while datetime(month.year, month.month, 1) < end:
+        months.append(month)
+        month = month_bounds(month)[1]
+    return months
+
+
+def get_occupancy(cur, bucket, start, end):
+    start_notification_listener()
+    months = occupancy_months(start, end)
+    results = {}
+    with occupancy_lock:
+        generation = occupancy_state["generation"]
+        for month in months:
+            if (bucket, month) in occupancy_cache:
+                results[month] = occupancy_cache[(bucket, month)]
+
+    missing = [month for month in months if month not in results]
+    if missing:
+        # Os meses em falta são calculados numa só query, em meses completos. Os meses terminados
+        # ficam em cache até uma notificação da principal: são calculados na principal, para que
+        # uma réplica atrasada não volte a pôr em cache os valores antigos
+        now = datetime.now()
+        closed = [month for month in missing
+                  if datetime.combine(month_bounds(month)[1], datetime.min.time()) <= now]
+        step, step_sql, _ = OCCUPANCY_BUCKETS[bucket]
+        query_from = datetime(missing[0].year, missing[0].month, 1)
+        query_to = datetime.combine(month_bounds(missing[-1])[1], datetime.min.time())
+        params = {"from": query_from, "to": query_to, "bucket": bucket, "step": step_sql}
+        if closed:
+            primary = db_connection()
+            if isinstance(primary, tuple):
+                raise RuntimeError(primary[0]["msg"])
+            primary_cur = primary.cursor()
+            try:
+                primary_cur.execute(OCCUPANCY_SQL, params)
+                rows = primary_cur.fetchall()
+            finally:
+                primary_cur.close()
+                primary.close()
+        else:
+            cur.execute(OCCUPANCY_SQL, params)
+            rows = cur.fetchall()
+        computed = {}
+        for at, inpatients in rows:
+            computed.setdefault(at.date().replace(day=1), []).append((at, inpatients))
+
+        with occupancy_lock:
+            cacheable = occupancy_state["generation"] == generation
+            for month in missing:
+                results[month] = computed.get(month, [])
+                # Só os meses terminados (e sem alterações durante o cálculo) ficam em cache
+                if cacheable and month in closed:
+                    occupancy_cache[(bucket, month)] = results[month]
+            while len(occupancy_cache) > OCCUPANCY_CACHE_MAX_MONTHS:
+                del occupancy_cache[next(iter(occupancy_cache))]
+
+    return [(at, inpatients) for month in months for at, inpatients in results[month] if start <= at < end]
+
+
+@app.route('/dbproj/occupancy', methods=['GET'])
+@jwt_required()
+def hospitalization_occupancy():
+    # Validar o período (datas inclusivas) e o tamanho do intervalo
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in OCCUPANCY_BUCKETS:
+        return jsonify({"msg": "Invalid bucket, should be one of: " + ", ".join(OCCUPANCY_BUCKETS)}), 400
+    date_from, date_to = request.args.get('from'), request.args.get('to')
+    if not date_from or not date_to:
+        return jsonify({"msg": "Both 'from' and 'to' dates are required"}), 400
+    for date in (date_from, date_to):
+        validation_error = validate_date_format(date)
+        if validation_error:
+            return jsonify({"msg": validation_error}), 400
+    start = datetime.strptime(date_from, '%Y-%m-%d')
+    end = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+    step, _, time_format = OCCUPANCY_BUCKETS[bucket]
+    if end <= start:
+        return jsonify({"msg": "'to' must not be before 'from'"}), 400
+    if (end - start) / step > OCCUPANCY_MAX_BUCKETS:
+        return jsonify({"msg": f"Period too long (maximum of {OCCUPANCY_MAX_BUCKETS} buckets)"}), 400
+
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um assistente
+    execute_prepared(cur, 'is_assistant', (current_user,))
+    if not cur.fetchone():
+        return jsonify({"msg": "Only assistants can see hospitalization occupancy"}), 400
+
+    try:
+        occupancy = get_occupancy(cur, bucket, start, end)
+        return jsonify({"status": 200, "results": [{"time": at.strftime(time_format), "inpatients": inpatients}
+                                                   for at, inpatients in occupancy]}), 200
+    except Exception as e:
+        return jsonify({"status": 500, "errors": str(e)}), 500
+    finally:
+        cur.close()
+        db.close()
+
+
+##########################################################
+# REPORT JOBS
+##########################################################
+# Relatórios calculados em segundo plano: SQL do JSON de 'results' e parâmetros de cada tipo
+REPORT_JOB_TYPES = {
+    'monthly_report': MONTHLY_REPORT_SQL,
+    'daily_summary': DAILY_SUMMARY_SQL,
+}
+
+REPORT_WORKERS = 2
+REPORT_WORKER_POLL_INTERVAL = 1
+# Tempo durante o qual um resultado é reutilizado por pedidos idênticos
+REPORT_RESULT_TTL = 10 * 60
+# Trabalhos 'running' há mais tempo do que isto são considerados abandonados e voltam à fila
+REPORT_JOB_TIMEOUT = 10 * 60
+REPORT_CLEANUP_INTERVAL = 60 * 60
+
+report_workers_started = False
+report_workers_lock = threading.Lock()
+
+SUBMIT_REPORT_JOB_SQL = '''
+    WITH cached AS (
+        SELECT job_id, status FROM report_jobs
+        WHERE dedup_key = %(dedup_key)s AND status = 'done' AND expires_at > NOW()
+        ORDER BY expires_at DESC LIMIT 1
+    ), inflight AS (
+        SELECT job_id, status FROM report_jobs
+        WHERE dedup_key = %(dedup_key)s AND status IN ('queued', 'running')
+    ), inserted AS (
+        INSERT INTO report_jobs (job_type, params, dedup_key, requested_by)
+        SELECT %(job_type)s, %(params)s, %(dedup_key)s, %(username)s
+        WHERE NOT EXISTS (SELECT 1 FROM cached) AND NOT EXISTS (SELECT 1 FROM inflight)
+        ON CONFLICT DO NOTHING
+        RETURNING job_id, status
+    )
+    SELECT * FROM cached
+    UNION ALL SELECT * FROM inflight
+    UNION ALL SELECT * FROM inserted
+    LIMIT 1
+'''
+
+CLAIM_REPORT_JOB_SQL = '''
+    UPDATE report_jobs SET status = 'running', started_at = NOW()
+    WHERE job_id = (
+        SELECT job_id FROM report_jobs
+        WHERE status = 'queued'
+        OR (status = 'running' AND started_at < NOW() - %(timeout)s * INTERVAL '1 second')
+        ORDER BY created_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING job_id, job_type, params
+'''
+
+
+def submit_report_job(cur, job_type, params, username):
+    # Pedidos idênticos (mesmo tipo e parâmetros) partilham o trabalho em curso ou o resultado em cache
+    params_json = json.dumps(params, sort_keys=True)
+    values = {"job_type": job_type, "params": params_json, "dedup_key": f'{job_type}:{params_json}',
+              "username": username}
+    for _ in range(2):
+        cur.execute(SUBMIT_REPORT_JOB_SQL, values)
+        job = cur.fetchone()
+        if job is not None:
+            return job
+    return None
+
+
+def run_report_job(job_type, params):
+    db = db_read_connection()
+    cur = db.cursor()
+    try:
+        cur.execute(f'SELECT ({REPORT_JOB_TYPES[job_type]})::text', params)
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
+        db.close()
+
+
+def process_report_job():
+    # Reserva um trabalho com SKIP LOCKED, calcula-o e guarda o resultado; devolve False se a fila estiver vazia
+    db = db_connection()
+    cur = db.cursor()
+    try:
+        cur.execute(CLAIM_REPORT_JOB_SQL, {"timeout": REPORT_JOB_TIMEOUT})
+        job = cur.fetchone()
+        db.commit()
+        if job is None:
+            return False
+
+        job_id, job_type, params = job
+        try:
+            result = run_report_job(job_type, params)
+            cur.execute('''UPDATE report_jobs SET status = 'done', result = %s, finished_at = NOW(),
+                           expires_at = NOW() + %s * INTERVAL '1 second' WHERE job_id = %s''',
+                        (result, REPORT_RESULT_TTL, job_id))
+        except Exception as e:
+            db.rollback()
+            cur.execute('''UPDATE report_jobs SET status = 'failed', error = %s, finished_at = NOW()
+                           WHERE job_id = %s''', (str(e), job_id))
+        db.commit()
+        return True
+    finally:
+        cur.close()
+        db.close()
+
+
+def cleanup_report_jobs():
+    db = db_connection()
+    cur = db.cursor()
+    try:
+        cur.execute("""DELETE FROM report_jobs WHERE status IN ('done', 'failed')
+                       AND COALESCE(expires_at, finished_at) < NOW() - INTERVAL '1 day'""")
+        db.commit()
+    finally:
+        cur.close()
+        db.close()
+
+
+def report_worker():
+    last_cleanup = 0
+    while True:
+        try:
+            if process_report_job():
+                continue
+            if time.monotonic() - last_cleanup > REPORT_CLEANUP_INTERVAL:
+                cleanup_report_jobs()
+                last_cleanup = time.monotonic()
+        except Exception as e:
+            logging.getLogger('logger').warning(f'Report worker error: {e}')
+        time.sleep(REPORT_WORKER_POLL_INTERVAL)
+
+
+def start_report_workers():
+    global report_workers_started
+    with report_workers_lock:
+        if report_workers_started:
+            return
+        report_workers_started = True
+    for _ in range(REPORT_WORKERS):
+        threading.Thread(target=report_worker, daemon=True).start()
+
+
+@app.route('/dbproj/jobs', methods=['POST'])
+@jwt_required()
+@validate_body(REPORT_JOB_SCHEMA)
+def submit_report():
+    # Obter o tipo de relatório e os respetivos parâmetros
+    job_type = request.json.get('type')
+    if job_type == 'monthly_report':
+        params = monthly_report_params()
+    else:
+        date = request.json.get('date')
+        if date is None:
+            return jsonify({"msg": "Invalid request body", "errors": {"date": "Missing required field"}}), 400
+        params = daily_summary_params(date)
+
     # Conectar à base de dados
     db = db_connection()
     cur = db.cursor()
@@ -1039,28 +2326,654 @@ def generate_monthly_report():
     current_user = get_jwt_identity()
 
     # Verificar se o utilizador é um assistente
-    cur.execute('SELECT 1 FROM assistants WHERE LOWER(employee_contract_person_username) = LOWER(%s)', (current_user,))
+    execute_prepared(cur, 'is_assistant', (current_user,))
     if not cur.fetchone():
-        return jsonify({"msg": "Only assistants can generate a monthly report"}), 400
+        cur.close()
+        db.close()
+        return jsonify({"msg": "Only assistants can generate reports"}), 400
 
     try:
-        # Sample SQL to get monthly report for doctors with most surgeries
-        cur.execute('''
-        SELECT EXTRACT(MONTH FROM surgery_date) as month, doctors.doctor_name, COUNT(surgery_id) as total_surgeries
-        FROM surgeries 
-        JOIN doctors ON surgeries.doctors_employee_contract_person_username = doctors.employee_contract_person_username
-        WHERE surgery_date > current_date - INTERVAL '1 YEAR'
-        GROUP BY month, doctors.doctor_name
-        ORDER BY month, total_surgeries DESC
-        ''')
-        reports = cur.fetchall()
-        results = [{"month": int(report[0]), "doctor": report[1], "surgeries": report[2]} for report in reports]
+        job_id, status = submit_report_job(cur, job_type, params, current_user)
+        db.commit()
+        start_report_workers()
+        return jsonify({"status": 202, "results": {"job_id": job_id, "state": status}}), 202
+    except Exception as e:
+        db.rollback()
+        return jsonify({"status": 500, "errors": str(e)}), 500
+    finally:
+        cur.close()
+        db.close()
+
+
+@app.route('/dbproj/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def report_status(job_id):
+    # Conectar à base de dados
+    db = db_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um assistente
+    execute_prepared(cur, 'is_assistant', (current_user,))
+    if not cur.fetchone():
+        cur.close()
+        db.close()
+        return jsonify({"msg": "Only assistants can see reports"}), 400
+
+    try:
+        cur.execute('SELECT 1 FROM report_jobs WHERE job_id = %s', (job_id,))
+        if cur.fetchone() is None:
+            return jsonify({"msg": "Job not found"}), 400
+
+        # O resultado guardado já é JSON: é inserido no documento sem ser descodificado na API
+        return json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', json_build_object(
+                       'job_id', job_id,
+                       'type', job_type,
+                       'state', status,
+                       'created_at', created_at,
+                       'finished_at', finished_at,
+                       'result', result::json,
+                       'error', error))::text
+            FROM report_jobs WHERE job_id = %s
+        ''', (job_id,))
+    finally:
+        cur.close()
+        db.close()
+
+
+##########################################################
+# DOCTORS BY SPECIALIZATION
+##########################################################
+@app.route('/dbproj/specializations/<int:specialization_id>/doctors', methods=['GET'])
+@jwt_required()
+def doctors_by_specialization(specialization_id):
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    try:
+        cur.execute('SELECT 1 FROM specializations WHERE specialization_id = %s', (specialization_id,))
+        if cur.fetchone() is None:
+            return jsonify({"msg": "Specialization not found"}), 400
+
+        # Médicos da especialização e de todas as suas subespecializações: um único 'join' com o fecho
+        return json_passthrough(cur, '''
+            SELECT json_build_object('status', 200, 'results', COALESCE(json_agg(json_build_object(
+                       'doctor_id', d.doctor,
+                       'depth', d.depth,
+                       'specializations', d.specializations) ORDER BY d.depth, d.doctor), '[]'::json))::text
+            FROM (
+                SELECT sd.doctors_employee_contract_person_username AS doctor,
+                       MIN(c.depth) AS depth,
+                       json_agg(json_build_object('id', s.specialization_id, 'name', s.specialization)
+                                ORDER BY c.depth) AS specializations
+                FROM specializations_closure c
+                JOIN specializations_doctors sd ON sd.specializations_specialization_id = c.descendant_specialization_id
+                JOIN specializations s ON s.specialization_id = c.descendant_specialization_id
+                WHERE c.ancestor_specialization_id = %s
+                GROUP BY sd.doctors_employee_contract_person_username
+            ) d
+        ''', (specialization_id,))
+    finally:
+        cur.close()
+        db.close()
+
+
+##########################################################
+# SEARCH PEOPLE
+##########################################################
+SEARCH_MIN_QUERY_LENGTH = 3
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# Semelhança mínima (pg_trgm) para um nome ou email ser considerado
+SEARCH_SIMILARITY_THRESHOLD = 0.3
+
+# Condição de cada perfil sobre a coluna 'username' indicada
+SEARCH_ROLES = {
+    'patient': 'EXISTS (SELECT 1 FROM patient r WHERE r.person_username = {username})',
+    'doctor': 'EXISTS (SELECT 1 FROM doctors r WHERE r.employee_contract_person_username = {username})',
+    'nurse': 'EXISTS (SELECT 1 FROM nurses r WHERE r.employee_contract_person_username = {username})',
+    'assistant': 'EXISTS (SELECT 1 FROM assistants r WHERE r.employee_contract_person_username = {username})',
+}
+SEARCH_ROLE_CASE = ' '.join(f"WHEN {condition.format(username='m.username')} THEN '{role}'"
+                            for role, condition in SEARCH_ROLES.items())
+
+# Os três predicados do WHERE usam os índices GIN trigram (migrations/002_person_trigram_search.sql);
+# a ordenação (semelhança, username) permite a paginação por 'keyset'
+SEARCH_SQL = f'''
+    SET LOCAL pg_trgm.word_similarity_threshold = {SEARCH_SIMILARITY_THRESHOLD};
+    SELECT m.username, m.name, m.email, m.mobile_number, m.score,
+           CASE {SEARCH_ROLE_CASE} END AS role
+    FROM (
+        SELECT p.username, p.name, p.email, p.mobile_number,
+               GREATEST(word_similarity(%(q)s, p.name), word_similarity(%(q)s, p.email),
+                        CASE WHEN p.mobile_number::text LIKE %(like)s THEN 1 ELSE 0 END)::real AS score
+        FROM person p
+        WHERE (%(q)s <%% p.name OR %(q)s <%% p.email OR p.mobile_number::text LIKE %(like)s)
+        AND {{role_filter}}
+    ) m
+    WHERE %(after_score)s::real IS NULL
+    OR m.score < %(after_score)s::real
+    OR (m.score = %(after_score)s::real AND m.username > %(after_username)s)
+    ORDER BY m.score DESC, m.username
+    LIMIT %(limit)s
+'''
+
+
+def encode_search_cursor(score, username):
+    return base64.urlsafe_b64encode(json.dumps([score, username]).encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    try:
+        score, username = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), str(username)
+    except (ValueError, TypeError):
+        return None
+
+
+@app.route('/dbproj/search', methods=['GET'])
+@jwt_required()
+def search_people():
+    # Obter os parâmetros da pesquisa
+    q = request.args.get('q', '').strip()
+    if len(q) < SEARCH_MIN_QUERY_LENGTH:
+        return jsonify({"msg": f"Query must have at least {SEARCH_MIN_QUERY_LENGTH} characters"}), 400
+
+    role = request.args.get('role')
+    if role is not None and role not in SEARCH_ROLES:
+        return jsonify({"msg": "Role must be one of: " + ", ".join(SEARCH_ROLES)}), 400
+
+    limit = request.args.get('limit', str(SEARCH_DEFAULT_LIMIT))
+    if not limit.isdigit() or not 0 < int(limit) <= SEARCH_MAX_LIMIT:
+        return jsonify({"msg": f"Limit must be between 1 and {SEARCH_MAX_LIMIT}"}), 400
+
+    after_score, after_username = None, None
+    if request.args.get('after'):
+        cursor = decode_search_cursor(request.args['after'])
+        if cursor is None:
+            return jsonify({"msg": "Invalid cursor"}), 400
+        after_score, after_username = cursor
+
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um funcionário (assistente, médico ou enfermeiro)
+    execute_prepared(cur, 'is_employee', (current_user,))
+    if not cur.fetchone():
+        cur.close()
+        db.close()
+        return jsonify({"msg": "Only employees can search people"}), 400
+
+    # O padrão LIKE do número de telemóvel é escapado (o utilizador pode escrever '%' ou '_')
+    like = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+    try:
+        role_filter = SEARCH_ROLES[role].format(username='p.username') if role else 'TRUE'
+        cur.execute(SEARCH_SQL.format(role_filter=role_filter),
+                    {"q": q, "like": like, "after_score": after_score, "after_username": after_username,
+                     "limit": int(limit)})
+        rows = cur.fetchall()
+        results = [{"username": row[0], "name": row[1], "email": row[2], "mobile_number": row[3],
+                    "score": row[4], "role": row[5]} for row in rows]
+        next_cursor = encode_search_cursor(rows[-1][4], rows[-1][0]) if len(rows) == int(limit) else None
+        return jsonify({"status": 200, "results": results, "next": next_cursor}), 200
+    finally:
+        cur.close()
+        db.close()
+
+
+##########################################################
+# CSV EXPORTS
+##########################################################
+# Conjuntos de dados exportáveis: query e coluna de data usada no filtro por intervalo
+EXPORT_DATASETS = {
+    'appointments': ('''SELECT appointment_id, appointment_date, patient_person_username,
+                               doctors_employee_contract_person_username
+                        FROM appointments''', 'appointment_date'),
+    'surgeries': ('''SELECT surgery_id, surgery_date, hospitalizations_hospitalization_id,
+                            doctors_employee_contract_person_username
+                     FROM surgeries''', 'surgery_date'),
+    'bills': ('''SELECT bill_id, patient_person_username, appointments_appointment_id,
+                        hospitalizations_hospitalization_id, total_price, amount_paid, deadline_date, payment_method
+                 FROM bills''', 'deadline_date'),
+    'payments': ('''SELECT payment_id, bills_bill_id, payment_amount, payment_method, deadline_date
+                    FROM payments''', 'deadline_date'),
+}
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Número máximo de blocos em memória entre o COPY e a resposta HTTP
+EXPORT_QUEUE_CHUNKS = 16
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class CopyStream:
+    # Destino do 'COPY ... TO STDOUT': agrupa os dados em blocos e entrega-os à resposta HTTP
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        # Cliente desligado: interromper o COPY em vez de continuar a ler a tabela
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        self.buffer += data.encode() if isinstance(data, str) else data
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        chunk, self.buffer = bytes(self.buffer), bytearray()
+        # Fila limitada: se o cliente for mais lento, o COPY espera (memória constante)
+        while True:
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                if self.cancelled.is_set():
+                    raise ExportCancelled()
+
+
+def stream_copy(db, copy_sql, compress):
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+
+    def run_copy():
+        cur = db.cursor()
+        stream = CopyStream(chunks, cancelled)
+        try:
+            cur.copy_expert(copy_sql, stream)
+            stream.flush()
+            chunks.put(None)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            if not cancelled.is_set():
+                chunks.put(e)
+        finally:
+            cur.close()
+
+    copy_thread = threading.Thread(target=run_copy, daemon=True)
+    copy_thread.start()
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    completed = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                completed = True
+                break
+            if isinstance(chunk, Exception):
+                # O estado HTTP já foi enviado: interromper a resposta
+                logging.getLogger('logger').warning(f'Export failed: {chunk}')
+                return
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        # Cliente desligou-se ou exportação terminada: parar o COPY e libertar a ligação
+        cancelled.set()
+        if not completed:
+            # Pedir ao servidor que cancele o COPY em curso (não espera pelo próximo bloco)
+            try:
+                db.cancel()
+            except Exception:
+                pass
+        while copy_thread.is_alive():
+            try:
+                chunks.get(timeout=1)
+            except queue.Empty:
+                pass
+        # Um COPY interrompido deixa a ligação num estado desconhecido: não volta ao 'pool'
+        if completed:
+            db.close()
+        else:
+            db.discard()
+
+
+@app.route('/dbproj/export/<dataset>', methods=['GET'])
+@jwt_required()
+def export_csv(dataset):
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"msg": "Invalid dataset"}), 400
+
+    # Obter o intervalo de datas (inclusivo) e a compressão
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    if not date_from or not date_to:
+        return jsonify({"msg": "Missing required fields: from, to"}), 400
+    for value in (date_from, date_to):
+        validation_error = validate_date_format(value)
+        if validation_error:
+            return jsonify({"msg": validation_error}), 400
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true', 'yes')
+
+    # Conectar a uma réplica de leitura (ou à base de dados principal)
+    db = db_read_connection()
+    cur = db.cursor()
+
+    current_user = get_jwt_identity()
+
+    # Verificar se o utilizador é um assistente
+    execute_prepared(cur, 'is_assistant', (current_user,))
+    if not cur.fetchone():
+        cur.close()
+        db.close()
+        return jsonify({"msg": "Only assistants can export data"}), 400
+
+    # O COPY não aceita parâmetros: os valores são incluídos com 'mogrify' (escapados pelo psycopg2)
+    query, date_column = EXPORT_DATASETS[dataset]
+    copy_sql = cur.mogrify(f'''
+        COPY ({query} WHERE {date_column} >= %s::date AND {date_column} < %s::date + 1)
+        TO STDOUT WITH (FORMAT csv, HEADER)
+    ''', (date_from, date_to)).decode()
+    cur.close()
+
+    filename = f'{dataset}_{date_from}_{date_to}.csv' + ('.gz' if compress else '')
+    return Response(stream_copy(db, copy_sql, compress),
+                    mimetype='application/gzip' if compress else 'text/csv',
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+##########################################################
+# BATCH
+##########################################################
+# Operações permitidas num pedido 'batch' (nome da função da rota correspondente)
+BATCH_OPERATIONS = {
+    'register_patient', 'register_assistant', 'register_nurse', 'register_doctor', 'login',
+    'schedule_appointment', 'see_appointments', 'schedule_surgery', 'get_prescriptions',
+    'check_prescription', 'add_prescription', 'execute_payment', 'list_bills',
+}
+BATCH_MAX_OPERATIONS = 50
+
+
+class BatchConnection:
+    # Ligação partilhada pelas operações de um 'batch'; 'close()' não fecha a ligação e, no modo
+    # transacional, 'commit()'/'rollback()' passam a atuar sobre um 'savepoint' por operação
+    def __init__(self, conn, atomic):
+        self.conn = conn
+        self.atomic = atomic
+        # Eventos de auditoria do modo transacional, enviados depois do 'commit' ou do 'rollback'
+        self.audit_events = []
+
+    def cursor(self, *args, **kwargs):
+        return self.conn.cursor(*args, **kwargs)
+
+    def begin_operation(self):
+        cur = self.conn.cursor()
+        if self.atomic:
+            cur.execute('SAVEPOINT batch_operation')
+        elif self.conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            # Operação anterior deixou a transação abortada sem 'rollback'
+            self.conn.rollback()
+        cur.close()
+
+    def commit(self):
+        if not self.atomic:
+            self.conn.commit()
+
+    def rollback(self):
+        if self.atomic:
+            cur = self.conn.cursor()
+            cur.execute('ROLLBACK TO SAVEPOINT batch_operation')
+            cur.close()
+        else:
+            self.conn.rollback()
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+def run_batch_operation(name, path, body, authorization):
+    # Executa a rota da operação num contexto de pedido próprio (mesma aplicação e mesma ligação)
+    rule = next(app.url_map.iter_rules(name))
+    method = next(iter(rule.methods - {'HEAD', 'OPTIONS'}))
+    headers = {"Authorization": authorization} if authorization else {}
+    builder = EnvironBuilder(path=path, method=method, json=body, headers=headers)
+    try:
+        with app.request_context(builder.get_environ()):
+            response = app.full_dispatch_request()
+    finally:
+        builder.close()
+    return response.status_code, response.get_json(silent=True)
+
+
+def queue_batch_audit_events(shared, committed):
+    # Após um 'rollback' as leituras continuam a ser registadas (os dados foram devolvidos na
+    # resposta), mas as escritas revertidas não
+    for event in shared.audit_events:
+        if committed or event[4] not in AUDIT_WRITE_ACTIONS:
+            queue_audit_event(event)
+    shared.audit_events.clear()
+
+
+@app.route('/dbproj/batch', methods=['POST'])
+def batch():
+    if not request.is_json:
+        return jsonify({"msg": "Missing JSON in request"}), 400
+
+    # Obter as operações e o modo transacional (tudo ou nada)
+    operations = request.json.get('operations')
+    atomic = bool(request.json.get('transaction', False))
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"msg": "Missing required field: operations"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"msg": f"At most {BATCH_MAX_OPERATIONS} operations per batch"}), 400
+    # Todas as operações são validadas antes de obter a ligação (incluindo os argumentos do URL)
+    paths = []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+            return jsonify({"msg": "Invalid operation in batch"}), 400
+        if not isinstance(operation.get('args', {}), dict):
+            return jsonify({"msg": "Operation args must be an object"}), 400
+        if operation.get('body') is not None and not isinstance(operation['body'], dict):
+            return jsonify({"msg": "Operation body must be an object"}), 400
+        try:
+            paths.append(url_for(operation['op'], **operation.get('args', {})))
+        except BuildError:
+            return jsonify({"msg": "Missing operation arguments"}), 400
+
+    # Conectar à base de dados (ligação única para todas as operações)
+    db = db_connection()
+    if isinstance(db, tuple):
+        return jsonify(db[0]), db[1]
+    shared = BatchConnection(db, atomic)
+    g.batch_connection = shared
+
+    # O token de quem faz o pedido é usado por omissão; com "use_login": true usa-se o da última operação 'login'
+    authorization = request.headers.get('Authorization')
+    login_authorization = None
+
+    results = []
+    failed = False
+    try:
+        for operation, path in zip(operations, paths):
+            name = operation['op']
+            op_authorization = login_authorization if operation.get('use_login') else authorization
+            shared.begin_operation()
+            try:
+                status, body = run_batch_operation(name, path, operation.get('body'), op_authorization)
+            except Exception as e:
+                shared.rollback()
+                status, body = 500, {"msg": str(e)}
+            results.append({"op": name, "status": status, "body": body})
+
+            if name == 'login' and status == 200 and body:
+                login_authorization = f'Bearer {body.get("access_token")}'
+
+            if status >= 400 and atomic:
+                failed = True
+                break
+
+        if atomic:
+            if failed:
+                db.rollback()
+                queue_batch_audit_events(shared, committed=False)
+                return jsonify({"status": 400, "transaction": "rolled back", "results": results}), 400
+            db.commit()
+            queue_batch_audit_events(shared, committed=True)
         return jsonify({"status": 200, "results": results}), 200
+    except Exception as e:
+        db.rollback()
+        queue_batch_audit_events(shared, committed=False)
+        return jsonify({"status": 500, "errors": str(e), "results": results}), 500
+    finally:
+        g.batch_connection = None
+        db.close()
+
+
+##########################################################
+# SCHEDULE FEED (SERVER-SENT EVENTS)
+##########################################################
+# Canal notificado pelos triggers de appointments, surgeries e nurses_surgeries
+SCHEDULE_CHANNEL = 'schedule_changes'
+# Eventos em espera por cliente (um cliente lento perde os mais antigos)
+SCHEDULE_QUEUE_SIZE = 100
+SCHEDULE_KEEPALIVE_SECONDS = 15
+
+schedule_subscribers = {}
+schedule_lock = threading.Lock()
+
+
+def subscribe_schedule(username):
+    events = queue.Queue(maxsize=SCHEDULE_QUEUE_SIZE)
+    with schedule_lock:
+        schedule_subscribers.setdefault(username.lower(), set()).add(events)
+    return events
+
+
+def unsubscribe_schedule(username, events):
+    with schedule_lock:
+        subscribers = schedule_subscribers.get(username.lower())
+        if subscribers is not None:
+            subscribers.discard(events)
+            if not subscribers:
+                del schedule_subscribers[username.lower()]
+
+
+def push_schedule_event(events, event):
+    while True:
+        try:
+            events.put_nowait(event)
+            return
+        except queue.Full:
+            try:
+                events.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def publish_schedule_event(payload):
+    # Entrega a notificação apenas aos utilizadores envolvidos no evento
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        return
+    with schedule_lock:
+        targets = [events for username in event.get('users') or []
+                   for events in schedule_subscribers.get(username, ())]
+    for events in targets:
+        push_schedule_event(events, (event.get('type'), payload))
+
+
+def publish_schedule_resync():
+    # Após uma falha da ligação podem ter-se perdido notificações: os clientes devem recarregar a agenda
+    with schedule_lock:
+        targets = [events for subscribers in schedule_subscribers.values() for events in subscribers]
+    for events in targets:
+        push_schedule_event(events, ('resync', '{}'))
+
+
+listen_channel(SCHEDULE_CHANNEL, publish_schedule_event, publish_schedule_resync)
+
+
+# O 'EventSource' dos browsers não envia cabeçalhos: o token também é aceite em '?jwt='
+@app.route('/dbproj/schedule/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def schedule_events():
+    current_user = get_jwt_identity()
+    start_notification_listener()
+    events = subscribe_schedule(current_user)
+
+    def stream():
+        try:
+            yield f'retry: {NOTIFY_RECONNECT_SECONDS * 1000}\n\n'
+            while True:
+                try:
+                    event_type, payload = events.get(timeout=SCHEDULE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: {event_type}\ndata: {payload}\n\n'
+        finally:
+            unsubscribe_schedule(current_user, events)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+##########################################################
+# PARTITION MAINTENANCE
+##########################################################
+PARTITION_MONTHS_AHEAD = 12
+PARTITION_MAINTENANCE_INTERVAL = 24 * 60 * 60
+# Nova tentativa mais cedo quando a manutenção falha
+PARTITION_RETRY_INTERVAL = 5 * 60
+
+
+def maintain_partitions():
+    # Cria as partições mensais em falta (ver 'migrations/001_monthly_partitioning.sql')
+    db = db_connection()
+    if isinstance(db, tuple):
+        logging.getLogger('logger').warning(f'Partition maintenance failed: {db[0]["msg"]}')
+        return False
+    cur = db.cursor()
+    try:
+        cur.execute('SELECT maintain_monthly_partitions(%s)', (PARTITION_MONTHS_AHEAD,))
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        logging.getLogger('logger').warning(f'Partition maintenance failed: {e}')
+        return False
     finally:
         cur.close()
         db.close()
 
 
+def schedule_partition_maintenance():
+    # O 'timer' é sempre rearmado, mesmo que a manutenção falhe (ex.: base de dados indisponível)
+    succeeded = False
+    try:
+        succeeded = maintain_partitions()
+    except Exception as e:
+        logging.getLogger('logger').warning(f'Partition maintenance failed: {e}')
+    finally:
+        interval = PARTITION_MAINTENANCE_INTERVAL if succeeded else PARTITION_RETRY_INTERVAL
+        timer = threading.Timer(interval, schedule_partition_maintenance)
+        timer.daemon = True
+        timer.start()
+
+
 if __name__ == '__main__':
     # Set up logging
     logging.basicConfig(filename='log_file.log')
@@ -1074,6 +2987,12 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+    schedule_partition_maintenance()
+    start_replica_monitor()
+    start_report_workers()
+    start_notification_listener()
+    start_audit_flusher()
+
     host = '127.0.0.1'
     port = 8080
     app.run(host=host, debug=True, threaded=True, port=port)
@@ -0,0 +1,268 @@
+-- Particionamento mensal (por intervalo de datas) das tabelas appointments, surgeries e payments
+--
+-- Executar uma única vez, depois do 'Generated DDL.txt'. Serve tanto para bases de dados novas
+-- como para bases de dados já em uso: cada tabela é renomeada para <tabela>_legacy, é criada a
+-- nova tabela particionada e os dados são copiados para as partições mensais.
+--
+-- Notas:
+--   * A chave primária passa a incluir a coluna de data (exigência do Postgres para tabelas
+--     particionadas). As chaves estrangeiras que apontavam para estas tabelas passam a ser
+--     verificadas por triggers dos dois lados: check_partitioned_reference na tabela filha (o valor
+--     referenciado tem de existir) e enforce_partitioned_reference na tabela particionada (remover ou
+--     alterar o 'id' de uma linha ainda referenciada é rejeitado ou propagado, conforme o ON DELETE /
+--     ON UPDATE da chave original).
+--   * Os índices, triggers e chaves estrangeiras da tabela original são recriados na nova tabela.
+--   * As partições futuras são criadas por maintain_monthly_partitions(), chamada pela API no
+--     arranque e uma vez por dia. Linhas fora das partições existentes caem na partição
+--     <tabela>_default e são movidas quando a partição do respetivo mês é criada.
+--   * archive_monthly_partition() desanexa a partição de um mês e move-a para o esquema 'archive'.
+
+BEGIN;
+
+CREATE SCHEMA IF NOT EXISTS archive;
+
+-- Nome da partição de um mês: <tabela>_yYYYYmMM
+CREATE OR REPLACE FUNCTION monthly_partition_name(parent TEXT, month DATE)
+RETURNS TEXT AS $$
+    SELECT format('%s_y%sm%s', parent, to_char(month, 'YYYY'), to_char(month, 'MM'));
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Coluna da chave de particionamento de uma tabela particionada
+CREATE OR REPLACE FUNCTION partition_key_column(parent TEXT)
+RETURNS TEXT AS $$
+    SELECT a.attname::TEXT
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = parent::regclass;
+$$ LANGUAGE sql STABLE;
+
+-- Cria a partição de um mês, movendo as linhas desse mês que estejam na partição por omissão
+CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month DATE)
+RETURNS VOID AS $$
+DECLARE
+    first_day DATE := date_trunc('month', month)::DATE;
+    next_day DATE := (date_trunc('month', month) + INTERVAL '1 month')::DATE;
+    part TEXT := monthly_partition_name(parent, date_trunc('month', month)::DATE);
+    key TEXT := partition_key_column(parent);
+BEGIN
+    IF to_regclass(quote_ident(part)) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part, parent);
+
+    IF to_regclass(quote_ident(parent || '_default')) IS NOT NULL THEN
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) '
+                       'INSERT INTO %I SELECT * FROM moved',
+                       parent || '_default', key, first_day, key, next_day, part);
+    END IF;
+
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, part, first_day, next_day);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent TEXT, from_month DATE, to_month DATE)
+RETURNS VOID AS $$
+DECLARE
+    m DATE := date_trunc('month', from_month)::DATE;
+BEGIN
+    WHILE m <= to_month LOOP
+        PERFORM create_monthly_partition(parent, m);
+        m := (m + INTERVAL '1 month')::DATE;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Garante as partições do mês atual e dos próximos 'months_ahead' meses
+CREATE OR REPLACE FUNCTION maintain_monthly_partitions(months_ahead INTEGER DEFAULT 12)
+RETURNS VOID AS $$
+DECLARE
+    parent TEXT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['appointments', 'surgeries', 'payments'] LOOP
+        PERFORM ensure_monthly_partitions(parent, current_date,
+                                          (current_date + make_interval(months => months_ahead))::DATE);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Desanexa a partição de um mês e move-a para o esquema 'archive'
+-- (para evitar bloqueios em tabelas grandes, pode usar-se 'DETACH PARTITION ... CONCURRENTLY'
+-- fora de uma transação, seguido de 'ALTER TABLE ... SET SCHEMA archive')
+CREATE OR REPLACE FUNCTION archive_monthly_partition(parent TEXT, month DATE)
+RETURNS TEXT AS $$
+DECLARE
+    part TEXT := monthly_partition_name(parent, date_trunc('month', month)::DATE);
+BEGIN
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part);
+    RETURN 'archive.' || part;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Substitui as chaves estrangeiras que apontam para tabelas particionadas
+-- TG_ARGV: coluna da tabela filha, tabela referenciada, coluna referenciada
+CREATE OR REPLACE FUNCTION check_partitioned_reference()
+RETURNS TRIGGER AS $$
+DECLARE
+    ref_value TEXT := to_jsonb(NEW) ->> TG_ARGV[0];
+    ref_found BOOLEAN;
+BEGIN
+    IF ref_value IS NULL THEN
+        RETURN NEW;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT)', TG_ARGV[1], TG_ARGV[2])
+    INTO ref_found USING ref_value;
+
+    IF NOT ref_found THEN
+        RAISE foreign_key_violation USING MESSAGE =
+            format('Key (%s)=(%s) is not present in table "%s"', TG_ARGV[0], ref_value, TG_ARGV[1]);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Lado da tabela referenciada das chaves estrangeiras substituídas por check_partitioned_reference
+-- (trigger AFTER: uma linha que muda de partição, p.ex. uma consulta remarcada para outro mês, é
+-- removida e inserida de novo, por isso só há violação se o valor deixou de existir na tabela)
+-- TG_ARGV: tabela referenciada, coluna referenciada, tabela filha, coluna da tabela filha,
+--          ação ao remover, ação ao alterar ('restrict' ou 'cascade')
+CREATE OR REPLACE FUNCTION enforce_partitioned_reference()
+RETURNS TRIGGER AS $$
+DECLARE
+    old_value TEXT := to_jsonb(OLD) ->> TG_ARGV[1];
+    new_value TEXT;
+    action TEXT := CASE TG_OP WHEN 'DELETE' THEN TG_ARGV[4] ELSE TG_ARGV[5] END;
+    ref_found BOOLEAN;
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        new_value := to_jsonb(NEW) ->> TG_ARGV[1];
+        IF new_value IS NOT DISTINCT FROM old_value THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF old_value IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT)', TG_ARGV[0], TG_ARGV[1])
+    INTO ref_found USING old_value;
+    IF ref_found THEN
+        RETURN NULL;
+    END IF;
+
+    IF action = 'cascade' THEN
+        IF TG_OP = 'DELETE' THEN
+            EXECUTE format('DELETE FROM %s WHERE %I = $1::BIGINT', TG_ARGV[2], TG_ARGV[3]) USING old_value;
+        ELSE
+            EXECUTE format('UPDATE %s SET %I = $2::BIGINT WHERE %I = $1::BIGINT', TG_ARGV[2], TG_ARGV[3], TG_ARGV[3])
+            USING old_value, new_value;
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %s WHERE %I = $1::BIGINT)', TG_ARGV[2], TG_ARGV[3])
+    INTO ref_found USING old_value;
+    IF ref_found THEN
+        RAISE foreign_key_violation USING MESSAGE =
+            format('Key (%s)=(%s) is still referenced from table "%s"', TG_ARGV[1], old_value, TG_ARGV[2]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Converte uma tabela existente numa tabela particionada por mês, preservando os dados,
+-- a sequência do 'id', os índices, os triggers e as chaves estrangeiras
+CREATE OR REPLACE FUNCTION partition_table_by_month(tbl TEXT, key TEXT, id_col TEXT)
+RETURNS VOID AS $$
+DECLARE
+    legacy TEXT := tbl || '_legacy';
+    seq TEXT := pg_get_serial_sequence(tbl, id_col);
+    index_defs TEXT[];
+    trigger_defs TEXT[];
+    fk_defs TEXT[];
+    def TEXT;
+    ref RECORD;
+    min_month DATE;
+    max_month DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = tbl::regclass) THEN
+        RETURN;
+    END IF;
+
+    -- Definições a recriar (obtidas antes de renomear, já com o nome final da tabela)
+    SELECT array_agg(pg_get_indexdef(i.indexrelid)) INTO index_defs
+    FROM pg_index i WHERE i.indrelid = tbl::regclass AND NOT i.indisprimary;
+
+    SELECT array_agg(pg_get_triggerdef(t.oid)) INTO trigger_defs
+    FROM pg_trigger t WHERE t.tgrelid = tbl::regclass AND NOT t.tgisinternal;
+
+    SELECT array_agg(format('ALTER TABLE %I ADD CONSTRAINT %I %s', tbl, c.conname, pg_get_constraintdef(c.oid)))
+    INTO fk_defs
+    FROM pg_constraint c WHERE c.conrelid = tbl::regclass AND c.contype = 'f';
+
+    -- Nova tabela particionada
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', tbl, legacy);
+    EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', legacy, tbl || '_pkey', legacy || '_pkey');
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (%I)',
+                   tbl, legacy, key);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (%I, %I)', tbl, id_col, key);
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I', seq, tbl, id_col);
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+
+    -- Partições para os meses com dados e cópia dos dados
+    EXECUTE format('SELECT MIN(%I)::DATE, MAX(%I)::DATE FROM %I', key, key, legacy) INTO min_month, max_month;
+    IF min_month IS NOT NULL THEN
+        PERFORM ensure_monthly_partitions(tbl, min_month, max_month);
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', tbl, legacy);
+
+    -- Chaves estrangeiras que apontavam para a tabela original passam a triggers de verificação
+    FOR ref IN
+        SELECT c.conname, c.conrelid::regclass::TEXT AS child, ca.attname AS child_col, pa.attname AS parent_col,
+               CASE c.confdeltype WHEN 'c' THEN 'cascade' ELSE 'restrict' END AS on_delete,
+               CASE c.confupdtype WHEN 'c' THEN 'cascade' ELSE 'restrict' END AS on_update
+        FROM pg_constraint c
+        JOIN pg_attribute ca ON ca.attrelid = c.conrelid AND ca.attnum = c.conkey[1]
+        JOIN pg_attribute pa ON pa.attrelid = c.confrelid AND pa.attnum = c.confkey[1]
+        WHERE c.confrelid = legacy::regclass AND c.contype = 'f'
+    LOOP
+        EXECUTE format('CREATE TRIGGER %I BEFORE INSERT OR UPDATE OF %I ON %s FOR EACH ROW '
+                       'EXECUTE FUNCTION check_partitioned_reference(%L, %L, %L)',
+                       ref.conname || '_check', ref.child_col, ref.child, ref.child_col, tbl, ref.parent_col);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE OR UPDATE OF %I ON %I FOR EACH ROW '
+                       'EXECUTE FUNCTION enforce_partitioned_reference(%L, %L, %L, %L, %L, %L)',
+                       ref.conname || '_enforce', ref.parent_col, tbl, tbl, ref.parent_col,
+                       ref.child, ref.child_col, ref.on_delete, ref.on_update);
+    END LOOP;
+
+    EXECUTE format('DROP TABLE %I CASCADE', legacy);
+
+    -- Índices, chaves estrangeiras e triggers da tabela original
+    FOREACH def IN ARRAY COALESCE(index_defs, '{}') LOOP
+        EXECUTE def;
+    END LOOP;
+    FOREACH def IN ARRAY COALESCE(fk_defs, '{}') LOOP
+        EXECUTE def;
+    END LOOP;
+    FOREACH def IN ARRAY COALESCE(trigger_defs, '{}') LOOP
+        EXECUTE def;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT partition_table_by_month('appointments', 'appointment_date', 'appointment_id');
+SELECT partition_table_by_month('surgeries', 'surgery_date', 'surgery_id');
+SELECT partition_table_by_month('payments', 'deadline_date', 'payment_id');
+
+-- Índices usados pelas verificações de disponibilidade, listagens e relatórios
+CREATE INDEX IF NOT EXISTS appointments_patient_date_idx ON appointments (patient_person_username, appointment_date);
+CREATE INDEX IF NOT EXISTS appointments_doctor_date_idx ON appointments (doctors_employee_contract_person_username, appointment_date);
+CREATE INDEX IF NOT EXISTS surgeries_doctor_date_idx ON surgeries (doctors_employee_contract_person_username, surgery_date);
+CREATE INDEX IF NOT EXISTS surgeries_hospitalization_idx ON surgeries (hospitalizations_hospitalization_id);
+
+SELECT maintain_monthly_partitions();
+
+COMMIT;
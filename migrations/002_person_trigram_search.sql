@@ -0,0 +1,18 @@
+-- Pesquisa aproximada de pessoas (nome, email e número de telemóvel) com índices trigram
+--
+-- Executar depois de '001_monthly_partitioning.sql'. Usado por 'GET /dbproj/search'.
+-- Em bases de dados grandes e em uso, os índices podem ser criados um a um com
+-- 'CREATE INDEX CONCURRENTLY' (fora de uma transação) para não bloquear escritas em 'person'.
+
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS person_name_trgm_idx ON person USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS person_email_trgm_idx ON person USING gin (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS person_mobile_number_trgm_idx ON person USING gin ((mobile_number::text) gin_trgm_ops);
+
+-- Verificação de perfil de funcionário (quem pode pesquisar)
+CREATE INDEX IF NOT EXISTS employee_contract_username_lower_idx ON employee_contract (LOWER(person_username));
+
+COMMIT;
@@ -0,0 +1,84 @@
+-- Mudança de linhas da partição por omissão sem disparar triggers
+--
+-- Executar depois de '002_person_trigram_search.sql'. create_monthly_partition() move as linhas de
+-- um mês da partição <tabela>_default para a nova partição com 'DELETE ... RETURNING' seguido de
+-- um INSERT numa tabela ainda não anexada. O DELETE disparava os triggers das linhas removidas
+-- (intervalos de schedule_slots, notificações do canal 'schedule_changes', versões dos pacientes)
+-- e o INSERT não disparava nenhum, pelo que as marcações movidas perdiam os intervalos em
+-- schedule_slots (e a proteção contra sobreposições). A mudança passa a ser feita com
+-- 'session_replication_role = replica' (apenas quando há linhas a mover, o que exige um
+-- superutilizador ou, a partir do PostgreSQL 15, 'GRANT SET ON PARAMETER session_replication_role').
+--
+-- No fim, os intervalos em falta são recriados. Se entretanto tiver sido marcada uma consulta ou
+-- cirurgia sobreposta, o script falha com a restrição de exclusão violada, indicando a marcação
+-- que tem de ser corrigida antes de o executar de novo.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month DATE)
+RETURNS VOID AS $$
+DECLARE
+    first_day DATE := date_trunc('month', month)::DATE;
+    next_day DATE := (date_trunc('month', month) + INTERVAL '1 month')::DATE;
+    part TEXT := monthly_partition_name(parent, date_trunc('month', month)::DATE);
+    key TEXT := partition_key_column(parent);
+    default_part TEXT := parent || '_default';
+    has_rows BOOLEAN := FALSE;
+    previous_role TEXT := current_setting('session_replication_role');
+BEGIN
+    IF to_regclass(quote_ident(part)) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part, parent);
+
+    IF to_regclass(quote_ident(default_part)) IS NOT NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)',
+                       default_part, key, first_day, key, next_day)
+        INTO has_rows;
+    END IF;
+
+    IF has_rows THEN
+        -- Mudar de partição não é remover nem inserir: os triggers das linhas não são disparados
+        PERFORM set_config('session_replication_role', 'replica', true);
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) '
+                       'INSERT INTO %I SELECT * FROM moved',
+                       default_part, key, first_day, key, next_day, part);
+        PERFORM set_config('session_replication_role', previous_role, true);
+    END IF;
+
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, part, first_day, next_day);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Intervalos perdidos por marcações já movidas com a versão anterior da função
+INSERT INTO schedule_slots (person_username, role, during, appointments_appointment_id)
+SELECT a.doctors_employee_contract_person_username, 'doctor',
+       tsrange(a.appointment_date, a.appointment_date + a.duration), a.appointment_id
+FROM appointments a
+WHERE NOT EXISTS (SELECT 1 FROM schedule_slots s
+                  WHERE s.appointments_appointment_id = a.appointment_id AND s.role = 'doctor')
+UNION ALL
+SELECT a.patient_person_username, 'patient',
+       tsrange(a.appointment_date, a.appointment_date + a.duration), a.appointment_id
+FROM appointments a
+WHERE NOT EXISTS (SELECT 1 FROM schedule_slots s
+                  WHERE s.appointments_appointment_id = a.appointment_id AND s.role = 'patient');
+
+INSERT INTO schedule_slots (person_username, role, during, surgeries_surgery_id)
+SELECT s.doctors_employee_contract_person_username, 'doctor',
+       tsrange(s.surgery_date, s.surgery_date + s.duration), s.surgery_id
+FROM surgeries s
+WHERE NOT EXISTS (SELECT 1 FROM schedule_slots ss
+                  WHERE ss.surgeries_surgery_id = s.surgery_id AND ss.role = 'doctor')
+UNION ALL
+SELECT ns.nurses_employee_contract_person_username, 'nurse',
+       tsrange(s.surgery_date, s.surgery_date + s.duration), s.surgery_id
+FROM nurses_surgeries ns
+JOIN surgeries s ON s.surgery_id = ns.surgeries_surgery_id
+WHERE NOT EXISTS (SELECT 1 FROM schedule_slots ss
+                  WHERE ss.surgeries_surgery_id = s.surgery_id AND ss.role = 'nurse'
+                  AND ss.person_username = ns.nurses_employee_contract_person_username);
+
+COMMIT;
@@ -0,0 +1,142 @@
+-- Dono e evento de origem das faturas em bases de dados já existentes
+--
+-- Executar depois de '003_partition_moves_without_triggers.sql'. Em bases de dados novas as colunas
+-- já são criadas pelo 'Generated DDL.txt' e este script não altera nada.
+--
+-- As faturas anteriores não guardavam a consulta de origem. A associação é deduzida apenas quando
+-- não há ambiguidade: a data de vencimento de uma fatura de consulta é sempre a data da consulta
+-- mais três meses, e só se associa a fatura quando essa data corresponde a uma única consulta sem
+-- fatura e a consulta a uma única fatura sem dono. As restantes faturas ficam sem dono (NULL): não
+-- aparecem em 'GET /dbproj/bills' nem podem ser pagas até serem associadas manualmente.
+
+BEGIN;
+
+ALTER TABLE bills ADD COLUMN IF NOT EXISTS patient_person_username VARCHAR(512);
+ALTER TABLE bills ADD COLUMN IF NOT EXISTS appointments_appointment_id BIGINT;
+ALTER TABLE bills ADD COLUMN IF NOT EXISTS hospitalizations_hospitalization_id BIGINT;
+ALTER TABLE appointments_bills ADD COLUMN IF NOT EXISTS bills_bill_id BIGINT;
+ALTER TABLE hospitalizations_bills ADD COLUMN IF NOT EXISTS bills_bill_id BIGINT;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'bills_fk1') THEN
+        ALTER TABLE bills ADD CONSTRAINT bills_fk1 FOREIGN KEY (patient_person_username) REFERENCES patient(person_username);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'bills_fk3') THEN
+        ALTER TABLE bills ADD CONSTRAINT bills_fk3 FOREIGN KEY (hospitalizations_hospitalization_id) REFERENCES hospitalizations(hospitalization_id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'appointments_bills_fk2') THEN
+        ALTER TABLE appointments_bills ADD CONSTRAINT appointments_bills_fk2 FOREIGN KEY (bills_bill_id) REFERENCES bills(bill_id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'hospitalizations_bills_fk2') THEN
+        ALTER TABLE hospitalizations_bills ADD CONSTRAINT hospitalizations_bills_fk2 FOREIGN KEY (bills_bill_id) REFERENCES bills(bill_id);
+    END IF;
+
+    -- appointments já é particionada (001): a referência é verificada por trigger
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'bills_fk2')
+       AND NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'bills_fk2_check') THEN
+        CREATE TRIGGER bills_fk2_check
+        BEFORE INSERT OR UPDATE OF appointments_appointment_id ON bills
+        FOR EACH ROW
+        EXECUTE FUNCTION check_partitioned_reference('appointments_appointment_id', 'appointments', 'appointment_id');
+    END IF;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS bills_patient_idx ON bills (patient_person_username, deadline_date);
+CREATE UNIQUE INDEX IF NOT EXISTS bills_appointment_idx ON bills (appointments_appointment_id);
+CREATE UNIQUE INDEX IF NOT EXISTS bills_hospitalization_idx ON bills (hospitalizations_hospitalization_id);
+
+-- Funções de criação das faturas que preenchem as novas colunas (iguais às do 'Generated DDL.txt')
+CREATE OR REPLACE FUNCTION create_appointment_bill()
+RETURNS TRIGGER AS $$
+DECLARE
+    deadline_date TIMESTAMP;
+    appt_bill_id BIGINT;
+BEGIN
+    -- Calcula a data de vencimento como a data da consulta mais três meses
+    deadline_date := NEW.appointment_date + INTERVAL '3 months';
+
+    -- Insere uma nova entrada na tabela de contas (bills), já com o paciente e a consulta de origem
+    INSERT INTO bills (total_price, deadline_date, payment_method, patient_person_username, appointments_appointment_id)
+    VALUES (100.00, deadline_date, NULL, NEW.patient_person_username, NEW.appointment_id)
+    RETURNING bill_id INTO appt_bill_id;
+
+    -- Insere uma nova entrada na tabela de associação entre consultas e contas (appointments_bills)
+    INSERT INTO appointments_bills (appointments_appointment_id, bills_bill_id)
+    VALUES (NEW.appointment_id, appt_bill_id);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION create_surgery_bill()
+RETURNS TRIGGER AS $$
+DECLARE
+    surgery_deadline_date TIMESTAMP;
+    surg_id BIGINT;
+BEGIN
+    -- Calcula a data de vencimento como a data da cirurgia mais três meses
+    surgery_deadline_date := NEW.surgery_date + INTERVAL '3 months';
+
+    -- Verifica se a hospitalização já tem uma conta associada
+    SELECT bill_id INTO surg_id
+    FROM bills
+    WHERE hospitalizations_hospitalization_id = NEW.hospitalizations_hospitalization_id;
+
+    IF FOUND THEN
+        -- Atualiza a conta da hospitalização existente
+        UPDATE bills
+        SET total_price = total_price + 500.00, deadline_date = surgery_deadline_date
+        WHERE bill_id = surg_id;
+
+    ELSE
+        -- Insere uma nova entrada na tabela de contas (bills), já com o paciente e a hospitalização de origem
+        INSERT INTO bills (total_price, deadline_date, payment_method, patient_person_username,
+                           hospitalizations_hospitalization_id)
+        SELECT 500.00, surgery_deadline_date, NULL, h.patient_person_username, h.hospitalization_id
+        FROM hospitalizations h
+        WHERE h.hospitalization_id = NEW.hospitalizations_hospitalization_id
+        RETURNING bill_id INTO surg_id;
+
+        -- Insere uma nova entrada na tabela de associação entre hospitalizações e contas (hospitalizations_bills)
+        INSERT INTO hospitalizations_bills (hospitalizations_hospitalization_id, bills_bill_id)
+        VALUES (NEW.hospitalizations_hospitalization_id, surg_id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS surgery_created_trigger ON surgeries;
+CREATE TRIGGER surgery_created_trigger
+AFTER INSERT ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION create_surgery_bill();
+
+-- Faturas de consultas anteriores: só as associações sem ambiguidade (ver nota no início)
+WITH candidates AS (
+    SELECT b.bill_id, a.appointment_id, a.patient_person_username,
+           COUNT(*) OVER (PARTITION BY b.bill_id) AS appointments_per_bill,
+           COUNT(*) OVER (PARTITION BY a.appointment_id) AS bills_per_appointment
+    FROM appointments_bills ab
+    JOIN appointments a ON a.appointment_id = ab.appointments_appointment_id
+    JOIN bills b ON b.deadline_date = a.appointment_date + INTERVAL '3 months'
+    WHERE ab.bills_bill_id IS NULL
+    AND b.patient_person_username IS NULL
+    AND b.appointments_appointment_id IS NULL
+    AND b.hospitalizations_hospitalization_id IS NULL
+)
+UPDATE bills b
+SET patient_person_username = c.patient_person_username, appointments_appointment_id = c.appointment_id
+FROM candidates c
+WHERE b.bill_id = c.bill_id
+AND c.appointments_per_bill = 1
+AND c.bills_per_appointment = 1;
+
+UPDATE appointments_bills ab
+SET bills_bill_id = b.bill_id
+FROM bills b
+WHERE b.appointments_appointment_id = ab.appointments_appointment_id
+AND ab.bills_bill_id IS NULL;
+
+COMMIT;
@@ -0,0 +1,84 @@
+-- Verificação, do lado da tabela particionada, das referências substituídas por triggers
+--
+-- Executar depois de '004_bill_owners.sql'. A versão anterior de '001_monthly_partitioning.sql'
+-- só criava o trigger check_partitioned_reference na tabela filha: era possível remover uma
+-- consulta ou cirurgia (ou alterar o seu 'id') que ainda tinha faturas, prescrições ou enfermeiros
+-- associados. Este script cria o trigger enforce_partitioned_reference em falta na tabela
+-- particionada para cada trigger check_partitioned_reference existente. Nenhuma das chaves
+-- estrangeiras originais tinha ON DELETE / ON UPDATE, pelo que a ação é sempre 'restrict'.
+-- Em bases de dados em que '001' já criou estes triggers, o script não altera nada.
+
+BEGIN;
+
+-- Lado da tabela referenciada das chaves estrangeiras substituídas por check_partitioned_reference
+-- (trigger AFTER: uma linha que muda de partição, p.ex. uma consulta remarcada para outro mês, é
+-- removida e inserida de novo, por isso só há violação se o valor deixou de existir na tabela)
+-- TG_ARGV: tabela referenciada, coluna referenciada, tabela filha, coluna da tabela filha,
+--          ação ao remover, ação ao alterar ('restrict' ou 'cascade')
+CREATE OR REPLACE FUNCTION enforce_partitioned_reference()
+RETURNS TRIGGER AS $$
+DECLARE
+    old_value TEXT := to_jsonb(OLD) ->> TG_ARGV[1];
+    new_value TEXT;
+    action TEXT := CASE TG_OP WHEN 'DELETE' THEN TG_ARGV[4] ELSE TG_ARGV[5] END;
+    ref_found BOOLEAN;
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        new_value := to_jsonb(NEW) ->> TG_ARGV[1];
+        IF new_value IS NOT DISTINCT FROM old_value THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF old_value IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT)', TG_ARGV[0], TG_ARGV[1])
+    INTO ref_found USING old_value;
+    IF ref_found THEN
+        RETURN NULL;
+    END IF;
+
+    IF action = 'cascade' THEN
+        IF TG_OP = 'DELETE' THEN
+            EXECUTE format('DELETE FROM %s WHERE %I = $1::BIGINT', TG_ARGV[2], TG_ARGV[3]) USING old_value;
+        ELSE
+            EXECUTE format('UPDATE %s SET %I = $2::BIGINT WHERE %I = $1::BIGINT', TG_ARGV[2], TG_ARGV[3], TG_ARGV[3])
+            USING old_value, new_value;
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %s WHERE %I = $1::BIGINT)', TG_ARGV[2], TG_ARGV[3])
+    INTO ref_found USING old_value;
+    IF ref_found THEN
+        RAISE foreign_key_violation USING MESSAGE =
+            format('Key (%s)=(%s) is still referenced from table "%s"', TG_ARGV[1], old_value, TG_ARGV[2]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    ref RECORD;
+BEGIN
+    FOR ref IN
+        SELECT left(t.tgname, -length('_check')) AS conname, t.tgrelid::regclass::TEXT AS child,
+               args[1] AS child_col, args[2] AS parent, args[3] AS parent_col
+        FROM pg_trigger t
+        CROSS JOIN LATERAL string_to_array(encode(t.tgargs, 'escape'), '\000') AS args
+        WHERE t.tgfoid = 'check_partitioned_reference'::regproc AND NOT t.tgisinternal
+    LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgrelid = ref.parent::regclass AND tgname = ref.conname || '_enforce') THEN
+            EXECUTE format('CREATE TRIGGER %I AFTER DELETE OR UPDATE OF %I ON %I FOR EACH ROW '
+                           'EXECUTE FUNCTION enforce_partitioned_reference(%L, %L, %L, %L, %L, %L)',
+                           ref.conname || '_enforce', ref.parent_col, ref.parent, ref.parent, ref.parent_col,
+                           ref.child, ref.child_col, 'restrict', 'restrict');
+        END IF;
+    END LOOP;
+END;
+$$;
+
+COMMIT;